@@ -1,127 +1,572 @@
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import (Flask, Response, request, jsonify, render_template,
+                   send_from_directory, stream_with_context, url_for)
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 import os
-from PIL import Image
 import tempfile
+import hashlib
 import io
+import itertools
+import json
+import logging
+import math
+import mmap
+import threading
+import time
+import uuid
+
+from archive import iter_zip, unique_name
+from image_processing import add_border  # re-exported for existing callers
+from image_processing import (FORMAT_EXTENSIONS, PreflightError, build_pipeline, estimate_memory,
+                              output_extension, probe, rendition_path)
+from job_queue import DEFAULT_DB_PATH, JobQueue, QueueFull, start_workers
+from memory_budget import MemoryBudget, MemoryBudgetExceeded
+from metrics import BYTES_BUCKETS, PIXELS_BUCKETS, Metrics
+from multipart_stream import iter_parts
+from result_cache import ResultCache, cache_key
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s %(message)s')
+logger = logging.getLogger('app')
 
 app = Flask(__name__, static_folder='static')
 
 # Configure upload settings
 UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Processed results are served from /temp/<id>.jpg until they expire
+RESULTS_FOLDER = os.path.join(tempfile.gettempdir(), 'results')
+os.makedirs(RESULTS_FOLDER, exist_ok=True)
+RESULT_TTL = int(os.environ.get('RESULT_TTL', 3600))  # seconds
+SWEEP_INTERVAL = 60  # seconds between deleting expired results and jobs
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'tiff'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
+# Uploads are streamed to disk part by part, so this bounds disk use, not memory
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 1024)) * 1024 * 1024
+
+# Uploads are checked against these from their header before decoding
+# (see image_processing.probe)
+IMAGE_LIMITS = {
+    'max_pixels': int(float(os.environ.get('MAX_IMAGE_MEGAPIXELS', 80)) * 1_000_000),
+    'max_side': int(os.environ.get('MAX_IMAGE_SIDE', 30_000)),
+}
+
+# Estimated memory of the images being processed at once, shared by every
+# web and job worker on the host. Uploads processed in the request wait up to
+# MEMORY_WAIT_SECONDS for room, queued ones as long as it takes; those that
+# cannot fit at all are rejected up front.
+memory_budget = MemoryBudget(
+    int(os.environ.get('MEMORY_BUDGET_MB', 2048)) * 1024 * 1024,
+    path=os.environ.get('MEMORY_BUDGET_FILE', os.path.join(tempfile.gettempdir(), 'memory-budget.json')),
+    timeout=float(os.environ.get('MEMORY_WAIT_SECONDS', 30)),
+)
+
+# Processing applied to every upload (see image_processing.DEFAULT_SPEC)
+UPLOAD_SPEC = {'width': 1200, 'border': 1, 'quality': 95, 'optimize': True}
+
+# Processed results, keyed on the uploaded bytes plus processing parameters
+result_cache = ResultCache(
+    directory=os.environ.get('RESULT_CACHE_DIR'),
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_MB', 512)) * 1024 * 1024,
+    memory_bytes=int(os.environ.get('RESULT_CACHE_MEMORY_MB', 32)) * 1024 * 1024,
+)
+
+# Background jobs: /upload enqueues, a pool of worker processes drains the queue.
+# JOB_WORKERS=0 leaves the pool to a separate `python job_queue.py` process.
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', DEFAULT_DB_PATH)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', os.cpu_count() or 1))
+jobs = JobQueue(JOB_DB_PATH, max_pending=int(os.environ.get('JOB_QUEUE_MAX', 500)))
+_workers_wanted = False
+_workers_started = False
+_sweeper_started = False
+
+# Per-image instrumentation, shared with the job workers through METRICS_DIR
+metrics = Metrics(os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'metrics')))
+metrics.counter('upload_files_total', 'Uploaded files by outcome')
+metrics.histogram('upload_stage_seconds', 'Time spent in each step of processing one upload')
+metrics.histogram('upload_file_seconds', 'Total time to process one uploaded file')
+metrics.histogram('upload_request_seconds', 'Time to answer an /upload request')
+metrics.histogram('upload_input_bytes', 'Size of uploaded files', buckets=BYTES_BUCKETS)
+metrics.histogram('upload_output_bytes', 'Size of processed results', buckets=BYTES_BUCKETS)
+metrics.histogram('upload_source_pixels', 'Pixel count of decoded uploads', buckets=PIXELS_BUCKETS)
+metrics.histogram('upload_memory_estimate_bytes', 'Estimated peak memory of processing one upload',
+                  buckets=BYTES_BUCKETS)
 
-# Helper functions from your existing code
-def add_border(image, border_width=1, border_color=(0, 0, 0)):
-    width, height = image.size
-    new_width = width + border_width * 2
-    new_height = height + border_width * 2
+def resize_and_process_image(image, exact=False):
+    """Resize an open image to 1200px wide and add the 1-pixel black border."""
+    return build_pipeline(UPLOAD_SPEC, exact=exact).process_image(image)
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def upload_options(form):
+    """
+    Read the processing options of an /upload request.
+
+    Returns:
+        dict of spec overrides (see image_processing.DEFAULT_SPEC)
+
+    Raises:
+        ValueError: If an option is malformed
+    """
+    options = {'exact': form.get('exact', 'false').lower() == 'true'}
+    sizes = form.get('sizes')
+    if sizes:
+        try:
+            options['sizes'] = [int(width) for width in sizes.split(',') if width.strip()]
+        except ValueError:
+            options['sizes'] = []
+        if not options['sizes'] or min(options['sizes']) <= 0:
+            raise ValueError(f'Invalid sizes: {sizes}')
     
-    bordered_image = Image.new('RGB', (new_width, new_height), border_color)
-    bordered_image.paste(image, (border_width, border_width))
-    return bordered_image
-
-def resize_and_process_image(image):
-    # Calculate new dimensions while maintaining aspect ratio
-    original_width, original_height = image.size
-    new_width = 1200
-    new_height = int((new_width / original_width) * original_height)
+    # Encoder settings; see image_processing.encoder_options
+    output_format = form.get('format')
+    if output_format:
+        if output_format.upper() not in FORMAT_EXTENSIONS:
+            raise ValueError(f'Invalid format: {output_format}')
+        options['format'] = output_format.upper()
+    encoder = form.get('encoder')
+    if encoder:
+        if encoder not in ('standard', 'fast', 'small'):
+            raise ValueError(f'Invalid encoder: {encoder}')
+        options['encoder'] = encoder
+    subsampling = form.get('subsampling')
+    if subsampling:
+        if subsampling not in ('4:4:4', '4:2:2', '4:2:0'):
+            raise ValueError(f'Invalid subsampling: {subsampling}')
+        options['subsampling'] = subsampling
+    for name, key, low, high in (('quality', 'quality', 1, 100), ('target_kb', 'target_bytes', 1, None)):
+        value = form.get(name)
+        if value:
+            try:
+                number = int(value)
+            except ValueError:
+                number = 0
+            if number < low or (high is not None and number > high):
+                raise ValueError(f'Invalid {name}: {value}')
+            options[key] = number * 1024 if key == 'target_bytes' else number
+    return options
+
+def map_upload(stream):
+    """Memory-map a file-backed upload so the decoder reads its pages instead of a copy."""
+    try:
+        return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        stream.seek(0)
+        return stream
+
+def reject_upload(filename, message):
+    """Result for a file refused before any decoding."""
+    logger.warning('rejected filename=%s reason=%r', filename, message)
+    metrics.inc('upload_files_total', status='invalid')
+    return {
+        'filename': filename,
+        'status': 'error',
+        'message': message
+    }
+
+def preflight_upload(source, filename, options=None):
+    """
+    Check an upload's name and header without decoding it.
+
+    Args:
+        source: Path or seekable file object holding the upload
+        filename: Name it was uploaded under
+        options: Spec overrides (see upload_options), for the memory estimate
+
+    Returns:
+        The error result for the `results` list, or None if it may be processed
+    """
+    filename = secure_filename(filename)
+    if not allowed_file(filename):
+        return reject_upload(filename, 'Invalid file type. Allowed types: ' + ', '.join(ALLOWED_EXTENSIONS))
+    try:
+        info = probe(source, IMAGE_LIMITS)
+    except PreflightError as e:
+        return reject_upload(filename, str(e))
+    needed = estimate_memory(info, dict(UPLOAD_SPEC, **(options or {})))
+    if needed > memory_budget.limit:
+        return reject_upload(filename, f'Processing this image needs about {needed / 2**20:.0f}MB, '
+                                       f'more than the {memory_budget.limit / 2**20:.0f}MB memory budget')
+    return None
+
+def process_upload(file, options=None, digest=None, memory_wait=None):
+    """
+    Process one uploaded file and write the result to RESULTS_FOLDER.
+    
+    Only this one image is held in memory, decoded from a memory map of the
+    upload where possible; the response refers to the result by ID and the
+    bytes are served from /temp/<id>.jpg.
     
-    # Resize the image
-    resized_img = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    Args:
+        file: FileStorage holding the upload
+        options: Spec overrides (see upload_options)
+        digest: hashlib.sha256 object already fed the upload's bytes, if known
+        memory_wait: Seconds to wait for room in the memory budget (default
+                     MEMORY_WAIT_SECONDS; math.inf waits as long as it takes)
     
-    # Add 1-pixel black border
-    bordered_img = add_border(resized_img)
+    Returns:
+        dict describing the outcome for the `results` list
+    """
+    filename = secure_filename(file.filename)
+    started = time.perf_counter()
     
-    return bordered_img
+    if not file or not allowed_file(filename):
+        return reject_upload(filename, 'Invalid file type. Allowed types: ' + ', '.join(ALLOWED_EXTENSIONS))
+    
+    timings = {}
+    source = None
+    try:
+        step = time.perf_counter()
+        if digest is None:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+                digest.update(chunk)
+        file.stream.seek(0, os.SEEK_END)
+        size = file.stream.tell()
+        source = map_upload(file.stream)
+        timings['read'] = time.perf_counter() - step
+        step = time.perf_counter()
+        try:
+            image_info = probe(source, IMAGE_LIMITS)
+        except PreflightError as e:
+            return reject_upload(filename, str(e))
+        timings['preflight'] = time.perf_counter() - step
+        step = time.perf_counter()
+        pipeline = build_pipeline(UPLOAD_SPEC, **(options or {}))
+        if pipeline.spec['sizes']:
+            widths = sorted(set(pipeline.spec['sizes']), reverse=True)
+            keys = {width: cache_key(digest, rendition=width, **pipeline.spec) for width in widths}
+        else:
+            keys = {pipeline.spec['width']: cache_key(digest, **pipeline.spec)}
+        outputs = {width: result_cache.get(key) for width, key in keys.items()}
+        cached = all(output is not None for output in outputs.values())
+        timings['cache_lookup'] = time.perf_counter() - step
+        
+        info = {}
+        if not cached:
+            needed = estimate_memory(image_info, pipeline.spec)
+            metrics.observe('upload_memory_estimate_bytes', needed)
+            try:
+                with memory_budget.reserve(needed, memory_wait) as reservation:
+                    timings['memory_wait'] = reservation.waited
+                    # Process the image; info receives per-stage timings, sizes and the quality used
+                    if pipeline.spec['sizes']:
+                        outputs = pipeline.process_renditions(source, info)
+                    else:
+                        outputs = {pipeline.spec['width']: pipeline.process_bytes(source, info)}
+            except MemoryBudgetExceeded as e:
+                logger.warning('over memory budget filename=%s needed=%d reason=%r', filename, needed, str(e))
+                metrics.inc('upload_files_total', status='over_budget')
+                return {
+                    'filename': filename,
+                    'status': 'error',
+                    'message': str(e)
+                }
+            timings.update(info['timings'])
+            width, height = info['source_size']
+            metrics.observe('upload_source_pixels', width * height)
+            step = time.perf_counter()
+            for width, output in outputs.items():
+                result_cache.put(keys[width], output)
+            timings['cache_store'] = time.perf_counter() - step
+        
+        step = time.perf_counter()
+        extension = output_extension(pipeline.spec)
+        renditions = []
+        for width in sorted(outputs, reverse=True):
+            result_id = uuid.uuid4().hex
+            with open(os.path.join(RESULTS_FOLDER, result_id + extension), 'wb') as f:
+                f.write(outputs[width])
+            renditions.append({
+                'width': width,
+                'id': result_id,
+                'size': len(outputs[width]),
+                'url': f'/temp/{result_id}{extension}'
+            })
+        
+        timings['write'] = time.perf_counter() - step
+        
+        elapsed = time.perf_counter() - started
+        for name, seconds in timings.items():
+            metrics.observe('upload_stage_seconds', seconds, stage=name)
+        metrics.observe('upload_file_seconds', elapsed, cached=str(cached).lower())
+        metrics.observe('upload_input_bytes', size)
+        for rendition in renditions:
+            metrics.observe('upload_output_bytes', rendition['size'], format=pipeline.spec['format'],
+                            encoder=pipeline.spec['encoder'])
+        metrics.inc('upload_files_total', status='success', cached=str(cached).lower())
+        logger.info('processed filename=%s cached=%s bytes_in=%d bytes_out=%d ms=%.1f stages=%s',
+                    filename, cached, size, sum(r['size'] for r in renditions), elapsed * 1000,
+                    ','.join(f'{name}:{seconds * 1000:.1f}' for name, seconds in timings.items()))
+        result = {
+            'id': renditions[0]['id'],
+            'filename': f'processed_{filename}',
+            'status': 'success',
+            'cached': cached,
+            'size': renditions[0]['size'],
+            'url': renditions[0]['url'],
+            'format': pipeline.spec['format']
+        }
+        if not cached:
+            result['encode_ms'] = round(info['timings'].get('encode', 0.0) * 1000, 1)
+            if pipeline.spec['target_bytes'] and not pipeline.spec['sizes']:
+                result['quality'] = info['quality']
+        if pipeline.spec['sizes']:
+            result['renditions'] = renditions
+        return result
+        
+    except Exception as e:
+        logger.exception('failed filename=%s', filename)
+        metrics.inc('upload_files_total', status='error')
+        return {
+            'filename': filename,
+            'status': 'error',
+            'message': f'Error processing image: {str(e)}'
+        }
+    finally:
+        if isinstance(source, mmap.mmap):
+            source.close()
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def process_queued_file(input_path, filename, digest=None, memory_wait=None, **options):
+    """Process an upload spooled to disk, then delete the spooled copy."""
+    try:
+        with open(input_path, 'rb') as f:
+            return process_upload(FileStorage(f, filename), options, digest, memory_wait)
+    finally:
+        os.remove(input_path)
+        # Runs in the job workers too; make their observations visible to /metrics
+        metrics.flush()
+
+def process_job_file(input_path, filename, **options):
+    """
+    Job worker handler: process_queued_file, waiting for room in the memory
+    budget as long as it takes, since nobody is holding a request open for it.
+    """
+    return process_queued_file(input_path, filename, memory_wait=math.inf, **options)
+
+def receive_uploads(boundary, fields, seen):
+    """
+    Yield each selected file of the request body as soon as it has arrived.
+
+    Files are spooled into UPLOAD_FOLDER (see multipart_stream.iter_parts);
+    the caller deletes them. Form fields go into `fields` and the names of
+    all file parts into `seen`.
+    """
+    step = time.perf_counter()
+    for part in iter_parts(request.stream, boundary, UPLOAD_FOLDER, fields):
+        seen.add(part.name)
+        if part.name != 'files' or not part.filename:
+            os.remove(part.path)
+            continue
+        metrics.observe('upload_stage_seconds', time.perf_counter() - step, stage='receive')
+        yield part
+        step = time.perf_counter()
+
+def ensure_workers():
+    """
+    Start the job worker pool on first use.
+
+    While another process owns the pool this is retried by the sweeper (see
+    sweep_forever), so one of the others takes over if that process exits.
+    """
+    global _workers_wanted, _workers_started
+    _workers_wanted = True
+    if not _workers_started and JOB_WORKERS > 0:
+        if start_workers(JOB_DB_PATH, process_job_file, JOB_WORKERS):
+            _workers_started = True
+
+def sweep_results(max_age=RESULT_TTL):
+    """Delete processed results and finished jobs older than max_age seconds."""
+    for path in jobs.purge(max_age):
+        try:
+            os.remove(path)  # a spooled upload its worker did not get to delete
+        except OSError:
+            pass
+    cutoff = time.time() - max_age
+    with os.scandir(RESULTS_FOLDER) as it:
+        for entry in it:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+def sweep_forever(interval=SWEEP_INTERVAL):
+    """Run sweep_results every interval seconds, and retry ensure_workers once it has been used."""
+    while True:
+        time.sleep(interval)
+        try:
+            sweep_results()
+            if _workers_wanted:
+                ensure_workers()
+        except Exception:
+            logger.exception('sweep failed')
+
+def ensure_sweeper():
+    """Start sweeping in the background on first use, rather than on every request."""
+    global _sweeper_started
+    if not _sweeper_started:
+        _sweeper_started = True
+        threading.Thread(target=sweep_forever, name='result-sweeper', daemon=True).start()
 
 @app.route('/upload', methods=['POST'])
 def upload_files():
+    started = time.perf_counter()
     try:
-        print("\n=== New Upload Request ===")
-        print(f"Request form data: {request.form}")
-        print(f"Request files: {request.files}")
-        
-        if 'files' not in request.files:
-            print("Error: No files part in request")
+        boundary = request.mimetype_params.get('boundary')
+        if request.mimetype != 'multipart/form-data' or not boundary:
+            logger.warning('rejected request reason=not_multipart')
             return jsonify({'error': 'No files part'}), 400
         
-        files = request.files.getlist('files')
-        print(f"Number of files received: {len(files)}")
+        # The body is read part by part: each file is processed (or spooled for
+        # the job queue) as soon as it has arrived, while later ones still upload.
+        # Option fields must therefore come before the files, as FormData sends them.
+        fields, seen = {}, set()
+        parts = receive_uploads(boundary, fields, seen)
+        first = next(parts, None)
         
-        if not files or all(file.filename == '' for file in files):
-            print("Error: No selected files")
-            return jsonify({'error': 'No selected files'}), 400
+        if first is None:
+            reason = 'No selected files' if 'files' in seen else 'No files part'
+            logger.warning('rejected request reason=%s', reason)
+            return jsonify({'error': reason}), 400
         
-        results = []
-        for file in files:
-            filename = secure_filename(file.filename)
-            print(f"\nProcessing file: {filename}")
+        try:
+            options = upload_options(fields)
+        except ValueError as e:
+            os.remove(first.path)
+            parts.close()
+            return jsonify({'error': str(e)}), 400
+        files = itertools.chain([first], parts)
+        stream = request.args.get('stream', fields.get('stream', ''))
+        ensure_sweeper()
+        
+        if stream in ('ndjson', 'sse'):
+            # Send each result as soon as it is ready
+            def generate():
+                for part in files:
+                    result = json.dumps(process_queued_file(part.path, part.filename, part.digest, **options))
+                    yield f'data: {result}\n\n' if stream == 'sse' else f'{result}\n'
             
-            if not file or not allowed_file(filename):
-                print(f"Error: Invalid file type for {filename}")
-                results.append({
-                    'filename': filename,
-                    'status': 'error',
-                    'message': 'Invalid file type. Allowed types: ' + ', '.join(ALLOWED_EXTENSIONS)
-                })
-                continue
-                
+            mimetype = 'text/event-stream' if stream == 'sse' else 'application/x-ndjson'
+            return Response(stream_with_context(generate()), mimetype=mimetype)
+        
+        if request.args.get('sync') != '1':
+            # Hand each file to the worker pool as soon as it has arrived, so the
+            # first is processed while later ones still upload. Rejected files go
+            # into the job already finished, so they never reach a worker.
+            job_id = jobs.create(**options)
+            count = 0
             try:
-                # Process the image
-                print(f"Opening image: {filename}")
-                img = Image.open(file)
-                print(f"Original size: {img.size}")
-                
-                processed_img = resize_and_process_image(img)
-                print(f"Processed size: {processed_img.size}")
-                
-                # Save to a BytesIO object
-                img_io = io.BytesIO()
-                processed_img.save(img_io, 'JPEG', quality=95, optimize=True)
-                img_io.seek(0)
-                
-                # Convert to base64
-                import base64
-                img_data = base64.b64encode(img_io.getvalue()).decode('utf-8')
-                
-                results.append({
-                    'filename': f'processed_{filename}',
-                    'status': 'success',
-                    'image_data': f'data:image/jpeg;base64,{img_data}'
-                })
-                print(f"Successfully processed: {filename}")
-                
+                for part in files:
+                    rejection = preflight_upload(part.path, part.filename, options)
+                    if rejection is not None:
+                        os.remove(part.path)
+                    try:
+                        # Refused with QueueFull once JOB_QUEUE_MAX files are pending
+                        jobs.add(job_id, count, part.path, part.filename, rejection)
+                    except QueueFull:
+                        if rejection is None:
+                            os.remove(part.path)
+                        raise
+                    count += 1
+                    ensure_workers()
+                jobs.close(job_id)
             except Exception as e:
-                import traceback
-                error_msg = f"Error processing {filename}: {str(e)}\n{traceback.format_exc()}"
-                print(error_msg)
-                results.append({
-                    'filename': filename,
-                    'status': 'error',
-                    'message': f'Error processing image: {str(e)}'
-                })
+                parts.close()
+                for path in jobs.cancel(job_id):
+                    os.remove(path)
+                if not isinstance(e, QueueFull):
+                    raise
+                return jsonify({'error': 'Server busy, try again shortly'}), 503, {'Retry-After': '5'}
+            
+            status_url = url_for('job_status', job_id=job_id)
+            logger.info('queued job=%s files=%d', job_id, count)
+            metrics.observe('upload_request_seconds', time.perf_counter() - started, mode='queued')
+            metrics.flush()
+            return jsonify({'job_id': job_id, 'status_url': status_url}), 202, {'Location': status_url}
+        
+        results = [process_queued_file(part.path, part.filename, part.digest, **options) for part in files]
         
-        print(f"\nReturning {len([r for r in results if r['status'] == 'success'])} successful results")
+        logger.info('answered files=%d succeeded=%d', len(results),
+                    len([r for r in results if r['status'] == 'success']))
+        metrics.observe('upload_request_seconds', time.perf_counter() - started, mode='sync')
+        metrics.flush()
         return jsonify(results)
         
+    except RequestEntityTooLarge:
+        limit = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+        return jsonify({'error': f'Upload larger than {limit}MB'}), 413
     except Exception as e:
-        import traceback
-        error_msg = f"Unexpected error in upload_files: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
+        logger.exception('upload_files failed')
         return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of the upload instrumentation."""
+    cache = result_cache.stats()
+    gauges = [
+        ('job_queue_pending', 'Queued or running upload tasks', jobs.pending()),
+        ('result_cache_hit_ratio', 'Result cache hit ratio of this process', cache['hit_rate']),
+        ('result_cache_disk_bytes', 'Size of the on-disk result cache', cache['disk_bytes']),
+        ('memory_budget_bytes', 'Memory budget for image processing', memory_budget.limit),
+        ('memory_budget_in_use_bytes', 'Estimated memory of images being processed now',
+         memory_budget.in_use()),
+    ]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
+def archive_entries(results):
+    """
+    (path, name in the archive) for every processed file of a job that is still stored.
+
+    Files are named as their download links name them (photo.png ->
+    processed_photo.jpg, or processed_photo_800.jpg and so on for
+    renditions); repeated names get a suffix.
+    """
+    entries, seen = [], set()
+    for result in results:
+        if result.get('status') != 'success':
+            continue
+        name = os.path.splitext(result['filename'])[0]
+        renditions = result.get('renditions') or [{'url': result['url']}]
+        for rendition in renditions:
+            stored = os.path.basename(rendition['url'])
+            path = os.path.join(RESULTS_FOLDER, stored)
+            if not os.path.exists(path):
+                continue  # expired (see RESULT_TTL)
+            arcname = name + os.path.splitext(stored)[1]
+            if 'width' in rendition:
+                arcname = rendition_path(arcname, rendition['width'])
+            entries.append((path, unique_name(arcname, seen)))
+    return entries
+
+@app.route('/jobs/<job_id>/archive')
+def job_archive(job_id):
+    """Every processed image of a finished job as one ZIP, streamed as it is built."""
+    status = jobs.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if status['status'] != 'done':
+        return jsonify({'error': 'Job is still running'}), 409, {'Retry-After': '1'}
+    entries = archive_entries(status['results'])
+    if not entries:
+        return jsonify({'error': 'No processed images to download'}), 404
+    logger.info('archive job=%s files=%d', job_id, len(entries))
+    return Response(iter_zip(entries), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="processed-{job_id[:8]}.zip"'})
+
 @app.route('/temp/<filename>')
 def get_processed_image(filename):
     try:
-        temp_file = os.path.join(tempfile.gettempdir(), filename)
-        return send_file(temp_file, as_attachment=True)
+        return send_from_directory(RESULTS_FOLDER, filename, as_attachment=request.args.get('download') == '1')
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
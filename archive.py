@@ -0,0 +1,108 @@
+"""
+Archive
+Write processed images into a ZIP, or stream one to a client as it is built
+"""
+
+import os
+import time
+import zipfile
+
+# Formats that are compressed already: deflating them again costs CPU for
+# a fraction of a percent, so they are stored as they are
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.webp', '.png', '.gif', '.zip')
+
+# Bytes read from a file, and at most buffered before being yielded, at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+def compression_for(name):
+    """ZIP compression method for a file: stored if its format is already compressed, else deflated."""
+    return zipfile.ZIP_STORED if name.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+
+
+def unique_name(name, seen):
+    """
+    name, or name with a " (2)", " (3)"... suffix if it is already in seen.
+
+    Adds the returned name to seen.
+    """
+    root, ext = os.path.splitext(name)
+    candidate, count = name, 1
+    while candidate in seen:
+        count += 1
+        candidate = f'{root} ({count}){ext}'
+    seen.add(candidate)
+    return candidate
+
+
+def _entries(archive, path, arcname):
+    """Yield after each CHUNK_SIZE of path has gone into the archive as arcname."""
+    stat = os.stat(path)
+    info = zipfile.ZipInfo(arcname, time.localtime(max(stat.st_mtime, 315532800))[:6])  # ZIP dates start in 1980
+    info.compress_type = compression_for(arcname)
+    info.file_size = stat.st_size  # lets zipfile decide on ZIP64 up front
+    with open(path, 'rb') as source, archive.open(info, 'w') as target:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            target.write(chunk)
+            yield
+
+
+def add_file(archive, path, arcname):
+    """
+    Copy a file into an open zipfile.ZipFile without reading it into memory.
+
+    JPEG, WebP and PNG outputs are stored rather than compressed again.
+
+    Args:
+        archive: zipfile.ZipFile opened for writing
+        path: File to add
+        arcname: Name inside the archive, with "/" separators
+    """
+    for _ in _entries(archive, path, arcname):
+        pass
+
+
+class _Spool:
+    """Write-only file object that collects what zipfile writes until it is taken."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(files):
+    """
+    Build a ZIP archive of files, yielding it piece by piece as it is written.
+
+    Nothing is seeked back to (sizes and checksums follow each entry in a data
+    descriptor), so the archive can go straight into a streamed HTTP response:
+    at most about CHUNK_SIZE of it is held in memory, however large it gets.
+
+    Args:
+        files: Iterable of (path, arcname) pairs
+
+    Yields:
+        Consecutive byte strings of the archive
+    """
+    spool = _Spool()
+    with zipfile.ZipFile(spool, 'w') as archive:
+        for path, arcname in files:
+            for _ in _entries(archive, path, arcname):
+                data = spool.take()
+                if data:
+                    yield data
+            data = spool.take()
+            if data:
+                yield data
+    yield spool.take()  # the central directory
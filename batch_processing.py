@@ -0,0 +1,239 @@
+"""
+Batch Processing Engine
+Spread per-file image work across a pool of worker processes
+"""
+
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Outcome of one task: `error` is None on success, otherwise the error message;
+# `value` is what func returned
+BatchResult = namedtuple('BatchResult', ['task', 'error', 'elapsed', 'value'], defaults=(None,))
+
+# Pool workers are spawned rather than forked: the caller may be the --serve
+# server, whose other threads can hold locks a forked child would inherit
+# held forever. Tasks and initializers must therefore be module-level functions.
+_POOL_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def default_workers():
+    """Number of worker processes to use when none is given."""
+    return os.cpu_count() or 1
+
+
+def _run_task(func, task):
+    """
+    Call func(*task) and capture the outcome instead of raising.
+
+    Runs inside the worker process, so it must stay a module-level function.
+    """
+    start = time.perf_counter()
+    value = None
+    try:
+        value = func(*task)
+        error = None
+    except Exception as e:
+        error = str(e)
+    return BatchResult(task, error, time.perf_counter() - start, value)
+
+
+def run_batch(func, tasks, workers=1, max_pending=None):
+    """
+    Run func(*task) for every task and yield results in completion order.
+
+    With one worker the tasks run in this process, one after another. With
+    more, they are spread over a process pool. At most `max_pending` tasks
+    (default twice the worker count) are submitted at a time, so only about
+    one decoded image per worker is ever held in memory.
+
+    Args:
+        func: Module-level callable that raises on failure
+        tasks: Iterable of argument tuples for func
+        workers: Number of worker processes (0 or None means one per core)
+        max_pending: Upper bound on submitted but unfinished tasks
+
+    Yields:
+        BatchResult for each task
+    """
+    if not workers:
+        workers = default_workers()
+
+    if workers == 1:
+        for task in tasks:
+            yield _run_task(func, task)
+        return
+
+    max_pending = max_pending or workers * 2
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_POOL_CONTEXT) as executor:
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(_run_task, func, task))
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def start_pool(workers=None, initializer=None):
+    """
+    Start a process pool with all of its workers running and initialised.
+
+    For long-lived callers that submit work as it arrives: without this the
+    processes are only started as the first tasks come in, so those tasks
+    would also pay for interpreter start-up and imports.
+
+    Args:
+        workers: Number of worker processes (0 or None means one per core)
+        initializer: Called once in each worker as it starts
+
+    Returns:
+        ProcessPoolExecutor; submit work with submit_task
+    """
+    workers = workers or default_workers()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                                   mp_context=_POOL_CONTEXT)
+    wait([executor.submit(os.getpid) for _ in range(workers)])
+    return executor
+
+
+def submit_task(executor, func, task):
+    """Submit func(*task) to a pool; the future's result is a BatchResult."""
+    return executor.submit(_run_task, func, task)
+
+
+def _umask():
+    """The process umask, read without changing it where the platform allows."""
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1], 8) for line in f if line.startswith('Umask:'))
+    except (OSError, StopIteration, ValueError):
+        mask = os.umask(0o022)  # the only portable way to read it is to set it
+        os.umask(mask)
+        return mask
+
+
+def replace_into_place(tmp_path, path):
+    """
+    Rename a finished temporary file to path.
+
+    mkstemp creates files readable by their owner only; they first get the
+    permissions a file opened normally would have (0666 less the umask), so
+    outputs look the same however they were written.
+    """
+    os.chmod(tmp_path, 0o666 & ~_umask())
+    os.replace(tmp_path, path)
+
+
+def write_atomic(path, data):
+    """Write data to a temporary file next to path, then rename it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        replace_into_place(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def run_pipelined(read, compute, write, tasks, readers=4, workers=None, writers=2, max_pending=None):
+    """
+    Run every task through read -> compute -> write with each step in its own thread pool.
+
+    While one image is being resampled the next ones are already being read
+    and earlier results written, so neither the disk (or network share) nor
+    the CPU waits for the other. Pillow releases the GIL while decoding,
+    resampling and encoding, so the compute threads run in parallel. At most
+    `max_pending` tasks (default twice the number of threads) are in flight,
+    which bounds the number of buffered images.
+
+    Args:
+        read: read(*task) -> data
+        compute: compute(data, *task) -> result; runs in the compute pool
+        write: write(result, *task) -> value stored in BatchResult.value
+        tasks: Iterable of argument tuples
+        readers: Threads reading inputs
+        workers: Compute threads (0 or None means one per core)
+        writers: Threads writing outputs
+        max_pending: Upper bound on tasks between starting to read and finishing the write
+
+    Yields:
+        BatchResult for each task, in completion order
+    """
+    workers = workers or default_workers()
+    max_pending = max_pending or (readers + workers + writers) * 2
+    steps = ((read, ThreadPoolExecutor(readers, 'read')),
+             (compute, ThreadPoolExecutor(workers, 'compute')),
+             (write, ThreadPoolExecutor(writers, 'write')))
+
+    def submit(step, task, started, arg=None):
+        func, executor = steps[step]
+        args = task if step == 0 else (arg,) + tuple(task)
+        pending[executor.submit(func, *args)] = (step, task, started)
+
+    tasks = iter(tasks)
+    pending = {}  # future -> (step index, task, perf_counter when its read started)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                    break
+                submit(0, task, time.perf_counter())
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, task, started = pending.pop(future)
+                try:
+                    value = future.result()
+                except Exception as e:
+                    yield BatchResult(task, str(e), time.perf_counter() - started)
+                    continue
+                if step < len(steps) - 1:
+                    submit(step + 1, task, started, value)
+                else:
+                    yield BatchResult(task, None, time.perf_counter() - started, value)
+    finally:
+        for _, executor in steps:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def summarize(results, started):
+    """
+    Build an aggregate summary for a finished batch.
+
+    Args:
+        results: List of BatchResult
+        started: time.perf_counter() value taken when the batch started
+
+    Returns:
+        dict with counts, wall time and throughput
+    """
+    elapsed = time.perf_counter() - started
+    failed = [r for r in results if r.error is not None]
+    return {
+        'total': len(results),
+        'succeeded': len(results) - len(failed),
+        'failed': len(failed),
+        'elapsed': elapsed,
+        'images_per_sec': len(results) / elapsed if elapsed > 0 else 0.0,
+    }
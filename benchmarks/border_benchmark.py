@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Border Micro-benchmark
+Time the fused resize+border stage in both border modes against a plain resize followed by add_border
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_processing import Pipeline, add_border
+
+
+def allocations(func):
+    """Number of Pillow images allocated while calling func()."""
+    before = Image.core.get_stats()['new_count']
+    func()
+    return Image.core.get_stats()['new_count'] - before
+
+
+def per_call(func, repeat):
+    """Average seconds per call of func()."""
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark border compositing')
+    parser.add_argument('--widths', default='1200,4000', help='Comma-separated target widths')
+    parser.add_argument('--border', type=int, default=1, help='Border width in pixels')
+    parser.add_argument('--color', default='black', help='Border colour')
+    parser.add_argument('--repeat', type=int, default=50, help='Calls per timing')
+    args = parser.parse_args()
+
+    for width in [int(w) for w in args.widths.split(',')]:
+        height = width * 2 // 3
+        b = args.border
+        # A source within 2x of the target, as after shrink-on-load
+        source = Image.effect_noise((width * 2, height * 2), 64).convert('RGB')
+
+        resize_only = Pipeline(stages=['resize'], width=width)
+        cases = {'resize+add_border': lambda: add_border(resize_only.process_image(source), b, args.color)}
+        for mode in ('expand', 'inset'):
+            pipeline = Pipeline(stages=['resize', 'border'], width=width, border=b,
+                                border_color=args.color, border_mode=mode)
+            cases[f'fused {mode}'] = lambda pipeline=pipeline: pipeline.process_image(source)
+
+        baseline = None
+        for name, func in cases.items():
+            elapsed = per_call(func, args.repeat)
+            baseline = baseline or elapsed
+            print(f"{width}px border={b} {name:17}: {elapsed * 1000:8.3f}ms, "
+                  f"{allocations(func)} allocs/image ({baseline / elapsed:.2f}x)")
+
+if __name__ == "__main__":
+    main()
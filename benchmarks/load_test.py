@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Load Test
+Drive /upload with concurrent clients and report throughput, latency percentiles and errors
+
+By default a local gunicorn is started with gunicorn.conf.py (and its own
+temporary queue, cache and metrics directories) and stopped afterwards; pass
+--url to test a server that is already running. Only the standard library is
+used on the client side, so the numbers are not skewed by a client library.
+"""
+
+import argparse
+import http.client
+import io
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from suite import ASPECTS, FORMATS, synthesize
+
+PERCENTILES = (50, 95, 99)
+
+
+def make_mix(formats, megapixels, aspects):
+    """
+    Encode one test image per combination.
+
+    Returns:
+        List of (filename, bytes)
+    """
+    mix = []
+    for mp in megapixels:
+        for aspect_name in aspects:
+            base = {}
+            for format_name in formats:
+                pil_format, ext, mode = FORMATS[format_name]
+                if mode not in base:
+                    base[mode] = synthesize(mp, ASPECTS[aspect_name], mode)
+                buffer = io.BytesIO()
+                base[mode].save(buffer, pil_format)
+                mix.append((f"{format_name}-{mp}mp-{aspect_name.replace(':', 'x')}{ext}", buffer.getvalue()))
+    return mix
+
+
+def multipart(files, fields=None):
+    """Encode a multipart/form-data body; option fields go first, as /upload requires."""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in (fields or {}).items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for filename, data in files:
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+                   f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        body.write(data)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+class Client:
+    """One simulated user: a keep-alive connection that uploads and waits for the results."""
+
+    def __init__(self, url, mode, timeout):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.mode = mode
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        for attempt in (0, 1):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request(method, self.prefix + path, body, headers or {})
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed an idle keep-alive connection; retry once on a new one
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+    def upload(self, files, fields):
+        """
+        Send one upload and wait until every file is processed.
+
+        Returns:
+            None on success, else a short description of what went wrong
+        """
+        body, content_type = multipart(files, fields)
+        query = {'sync': '?sync=1', 'ndjson': '?stream=ndjson', 'queued': ''}[self.mode]
+        status, data = self.request('POST', '/upload' + query, body, {'Content-Type': content_type})
+        if self.mode == 'queued':
+            if status != 202:
+                return f'HTTP {status}'
+            job_url = json.loads(data)['status_url']
+            while True:
+                status, data = self.request('GET', job_url)
+                if status != 200:
+                    return f'HTTP {status} polling'
+                job = json.loads(data)
+                if job['status'] == 'done':
+                    results = job['results']
+                    break
+                time.sleep(0.1)
+        elif status != 200:
+            return f'HTTP {status}'
+        elif self.mode == 'ndjson':
+            results = [json.loads(line) for line in data.splitlines() if line.strip()]
+        else:
+            results = json.loads(data)
+        if len(results) != len(files):
+            return f'{len(results)} results for {len(files)} files'
+        for result in results:
+            if result.get('status') != 'success':
+                return f"file error: {result.get('message', 'unknown')}"
+        return None
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty sorted list."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def run_level(url, mode, concurrency, duration, mix, files_per_request, fields, timeout):
+    """
+    Keep `concurrency` clients uploading back to back for `duration` seconds.
+
+    A request counts as failed if it gets an HTTP error, times out or has a
+    file that was not processed; latencies are those of successful requests.
+
+    Returns:
+        dict with request counts, errors by kind, throughput and latency percentiles
+    """
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    latencies, errors = [], {}
+    counts = {'requests': 0}
+
+    def user(seed):
+        client = Client(url, mode, timeout)
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            files = [rng.choice(mix) for _ in range(files_per_request)]
+            started = time.perf_counter()
+            try:
+                error = client.upload(files, fields)
+            except Exception as e:
+                error = type(e).__name__
+                client.connection = None
+            elapsed = time.perf_counter() - started
+            with lock:
+                counts['requests'] += 1
+                if error is None:
+                    latencies.append(elapsed)
+                else:
+                    errors[error] = errors.get(error, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(user, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': counts['requests'],
+        'elapsed': elapsed,
+        'requests_per_sec': len(latencies) / elapsed,
+        'images_per_sec': len(latencies) * files_per_request / elapsed,
+        'error_rate': sum(errors.values()) / max(counts['requests'], 1),
+        'errors': errors,
+        'latency_ms': {f'p{p}': latencies and percentile(latencies, p) * 1000 for p in PERCENTILES},
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(work, gunicorn_args):
+    """
+    Start gunicorn with gunicorn.conf.py on a free local port.
+
+    The job queue, result cache (disabled, so every upload is processed),
+    metrics and memory ledger go into `work`, away from any real instance.
+
+    Returns:
+        (Popen, base URL)
+    """
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), JOB_DB_PATH=os.path.join(work, 'jobs.sqlite3'),
+               RESULT_CACHE_DIR=os.path.join(work, 'cache'), RESULT_CACHE_MAX_MB='0',
+               RESULT_CACHE_MEMORY_MB='0', METRICS_DIR=os.path.join(work, 'metrics'),
+               MEMORY_BUDGET_FILE=os.path.join(work, 'memory-budget.json'), LOG_LEVEL='WARNING')
+    command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+               '--bind', f'127.0.0.1:{port}'] + gunicorn_args + ['app:app']
+    with open(os.path.join(work, 'gunicorn.log'), 'wb') as log:
+        server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=log)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            with open(os.path.join(work, 'gunicorn.log'), encoding='utf-8', errors='replace') as log:
+                raise SystemExit('gunicorn exited:\n' + log.read()[-2000:])
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return server, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('gunicorn did not start within 30s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the /upload endpoint')
+    parser.add_argument('--url', help='Server to test (default: start gunicorn with gunicorn.conf.py)')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='Comma-separated numbers of concurrent clients, one run each')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per concurrency level')
+    parser.add_argument('--mode', choices=['sync', 'ndjson', 'queued'], default='sync',
+                        help='sync: ?sync=1; ndjson: ?stream=ndjson; queued: job queue, polled until done')
+    parser.add_argument('--formats', default='jpeg,png', help='Comma-separated formats: ' + ', '.join(FORMATS))
+    parser.add_argument('--megapixels', default='2,12', help='Comma-separated image sizes in megapixels')
+    parser.add_argument('--aspects', default='3:2', help='Comma-separated aspect ratios: ' + ', '.join(ASPECTS))
+    parser.add_argument('--files-per-request', type=int, default=1, help='Images in each upload')
+    parser.add_argument('--sizes', help='Send sizes=... with each upload, e.g. 1200,400')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds before a request counts as failed')
+    parser.add_argument('--max-error-rate', type=float, default=0.01,
+                        help='Exit with status 1 if any level fails more requests than this (default 0.01)')
+    parser.add_argument('--output', help='Also write the results as JSON here')
+    parser.add_argument('--gunicorn-arg', action='append', default=[],
+                        help='Extra argument for the local gunicorn, e.g. --gunicorn-arg=--workers=4')
+    args = parser.parse_args()
+
+    mix = make_mix(args.formats.split(','), [float(mp) for mp in args.megapixels.split(',')],
+                   args.aspects.split(','))
+    fields = {'sizes': args.sizes} if args.sizes else {}
+    print(f"{len(mix)} test images, {sum(len(data) for _, data in mix) / len(mix) / 2**20:.1f}MB on average",
+          file=sys.stderr)
+
+    work = server = None
+    url = args.url
+    if url is None:
+        work = tempfile.mkdtemp(prefix='load-test-')
+        server, url = start_server(work, args.gunicorn_arg)
+    levels = []
+    try:
+        print(f"{'clients':>7} {'requests':>8} {'req/s':>7} {'img/s':>7} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'errors':>7}")
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            level = run_level(url, args.mode, concurrency, args.duration, mix, args.files_per_request,
+                              fields, args.timeout)
+            levels.append(level)
+            latency = level['latency_ms']
+            print(f"{concurrency:7d} {level['requests']:8d} {level['requests_per_sec']:7.2f} "
+                  f"{level['images_per_sec']:7.2f} " +
+                  ' '.join(f"{latency[f'p{p}']:8.0f}" if latency[f'p{p}'] else f"{'-':>8}"
+                           for p in PERCENTILES) +
+                  f" {level['error_rate'] * 100:6.1f}%")
+            for error, count in sorted(level['errors'].items()):
+                print(f"        {count} x {error}")
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+            shutil.rmtree(work, ignore_errors=True)
+
+    if args.output:
+        report = {'url': url if args.url else 'local gunicorn', 'mode': args.mode,
+                  'mix': [name for name, _ in mix], 'files_per_request': args.files_per_request,
+                  'cpu_count': os.cpu_count(), 'levels': levels}
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if any(level['error_rate'] > args.max_error_rate for level in levels):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""
+Benchmark Suite
+Measure throughput, per-stage latency and peak memory of every processing entry point
+
+Each scenario runs in a fresh interpreter so its peak RSS is its own. Results
+are written as JSON; pass a previous run as --baseline to flag regressions.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Megapixel counts for the quick and full profiles
+PROFILES = {
+    'quick': [0.5, 2, 12],
+    'full': [0.5, 2, 12, 24, 50],
+}
+
+# name -> (Pillow format, file extension, image mode)
+FORMATS = {
+    'jpeg': ('JPEG', '.jpg', 'RGB'),
+    'png': ('PNG', '.png', 'RGB'),
+    'webp': ('WEBP', '.webp', 'RGB'),
+    'tiff': ('TIFF', '.tiff', 'RGB'),
+    'rgba': ('PNG', '.png', 'RGBA'),
+    'palette': ('PNG', '.png', 'P'),
+}
+
+# name -> width / height
+ASPECTS = {
+    '3:2': 3 / 2,
+    '1:1': 1.0,
+    '9:16': 9 / 16,
+    '4:1': 4.0,
+}
+
+SCENARIOS = ('core', 'cli', 'upload')
+
+# Stored with the results: how to read their stages_ms
+STAGES_NOTE = ("stages_ms is the mean time per image in each pipeline stage; 'resize+border' is "
+               "one fused stage, so resizing and adding the border are not timed separately. "
+               "The cli and upload figures also include their own steps (e.g. read, preflight, write).")
+
+
+def synthesize(megapixels, aspect, mode):
+    """
+    Make a photo-like test image: smooth gradients with some noise, so it
+    compresses like a photograph rather than like pure noise or a flat colour.
+    """
+    from PIL import Image
+
+    width = int((megapixels * 1_000_000 * aspect) ** 0.5)
+    height = int(width / aspect)
+    noise = Image.effect_noise((width // 4 or 1, height // 4 or 1), 48).resize((width, height))
+    red = Image.linear_gradient('L').resize((width, height))
+    blue = Image.radial_gradient('L').resize((width, height))
+    image = Image.merge('RGB', (red, noise, blue))
+    if mode == 'RGBA':
+        image.putalpha(Image.linear_gradient('L').rotate(90).resize((width, height)))
+    elif mode == 'P':
+        image = image.quantize(256)
+    return image
+
+
+def make_corpus(directory, megapixels, formats, aspects):
+    """
+    Write one test image per combination into directory.
+
+    Returns:
+        List of dicts describing each image (id, path, format, megapixels, aspect, mode)
+    """
+    corpus = []
+    for mp in megapixels:
+        for aspect_name in aspects:
+            base = {}
+            for format_name in formats:
+                pil_format, ext, mode = FORMATS[format_name]
+                if mode not in base:
+                    base[mode] = synthesize(mp, ASPECTS[aspect_name], mode)
+                image_id = f"{format_name}-{mp}mp-{aspect_name.replace(':', 'x')}"
+                path = os.path.join(directory, image_id + ext)
+                base[mode].save(path, pil_format)
+                corpus.append({
+                    'id': image_id,
+                    'path': path,
+                    'format': format_name,
+                    'megapixels': mp,
+                    'aspect': aspect_name,
+                    'mode': mode,
+                    'bytes': os.path.getsize(path),
+                })
+    return corpus
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (None where unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_core(image, repeat, spec):
+    """Time the processing core on one image, stage by stage."""
+    from image_processing import build_pipeline
+
+    pipeline = build_pipeline(spec)
+    stages = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        context = pipeline.run(source=image['path'], output=io.BytesIO())
+        context['decoded'].close()
+        for name, seconds in context['timings'].items():
+            stages[name] = stages.get(name, 0.0) + seconds
+    elapsed = time.perf_counter() - start
+    return {
+        'images_per_sec': repeat / elapsed,
+        'stages_ms': {name: seconds * 1000 / repeat for name, seconds in stages.items()},
+    }
+
+
+def run_cli(image, repeat, spec, workers):
+    """Time image_resizer_cli.process_directory over `repeat` copies of one image."""
+    import contextlib
+    from image_resizer_cli import process_directory
+
+    work = tempfile.mkdtemp(prefix='bench-cli-')
+    try:
+        input_dir = os.path.join(work, 'in')
+        os.makedirs(input_dir)
+        ext = os.path.splitext(image['path'])[1]
+        for i in range(repeat):
+            shutil.copyfile(image['path'], os.path.join(input_dir, f'{i}{ext}'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = process_directory(input_dir, os.path.join(work, 'out'), workers=workers, spec=spec)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    if summary['failed']:
+        raise RuntimeError(f"{summary['failed']} images failed")
+    return {
+        'images_per_sec': summary['images_per_sec'],
+        'stages_ms': {name: seconds * 1000 / repeat for name, seconds in summary['stage_seconds'].items()},
+    }
+
+
+def run_upload(image, repeat, spec):
+    """
+    Time the Flask /upload route (processing in the request) via the test
+    client; the stage times come from its upload_stage_seconds metric.
+    """
+    import contextlib
+
+    work = tempfile.mkdtemp(prefix='bench-upload-')
+    # Keep the result cache out of the way so every request does the work
+    os.environ.update({'RESULT_CACHE_MAX_MB': '0', 'RESULT_CACHE_MEMORY_MB': '0',
+                       'RESULT_CACHE_DIR': os.path.join(work, 'cache'),
+                       'METRICS_DIR': os.path.join(work, 'metrics'),
+                       'JOB_DB_PATH': os.path.join(work, 'jobs.sqlite3'), 'JOB_WORKERS': '0'})
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app
+            client = app.app.test_client()
+            with open(image['path'], 'rb') as f:
+                data = f.read()
+            filename = os.path.basename(image['path'])
+            form = {'exact': 'true' if spec.get('exact') else 'false'}
+            start = time.perf_counter()
+            for _ in range(repeat):
+                response = client.post('/upload?sync=1', content_type='multipart/form-data',
+                                       data=dict(form, files=(io.BytesIO(data), filename)))
+                if response.status_code != 200 or response.json[0]['status'] != 'success':
+                    raise RuntimeError(f"Upload failed: {response.status_code} {response.data[:200]}")
+            elapsed = time.perf_counter() - start
+            stages = re.findall(r'^upload_stage_seconds_sum\{stage="([^"]+)"\} (\S+)$',
+                                app.metrics.render(), re.MULTILINE)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return {
+        'images_per_sec': repeat / elapsed,
+        'stages_ms': {name: float(seconds) * 1000 / repeat for name, seconds in stages},
+    }
+
+
+def run_one(job):
+    """Run a single scenario on a single image; called in a child interpreter."""
+    image, scenario, repeat, spec = job['image'], job['scenario'], job['repeat'], job['spec']
+    if scenario == 'core':
+        result = run_core(image, repeat, spec)
+    elif scenario == 'cli':
+        result = run_cli(image, repeat, spec, job['workers'])
+    else:
+        result = run_upload(image, repeat, spec)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_isolated(option, job):
+    """
+    Run `suite.py <option> <job>` in a fresh interpreter and return its JSON output.
+
+    Linux carries ru_maxrss across exec, so this parent stays small (it never
+    holds image data) to keep each child's peak RSS its own.
+    """
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), option, json.dumps(job)],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {'error': (proc.stderr.strip().splitlines() or ['failed'])[-1]}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare throughput against a baseline run.
+
+    Returns:
+        List of regression descriptions (empty if none)
+    """
+    previous = {(r['scenario'], r['image']['id']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['scenario'], result['image']['id']))
+        if not before or 'images_per_sec' not in before or 'images_per_sec' not in result:
+            continue
+        ratio = result['images_per_sec'] / before['images_per_sec']
+        result['vs_baseline'] = ratio
+        if ratio < 1 - threshold:
+            regressions.append(f"{result['scenario']} {result['image']['id']}: "
+                               f"{before['images_per_sec']:.2f} -> {result['images_per_sec']:.2f} images/sec "
+                               f"({(1 - ratio) * 100:.0f}% slower)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image processing entry points')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='quick',
+                        help='Image sizes to test: quick (0.5-12MP) or full (0.5-50MP)')
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help='Comma-separated formats: ' + ', '.join(FORMATS))
+    parser.add_argument('--aspects', default=','.join(ASPECTS),
+                        help='Comma-separated aspect ratios: ' + ', '.join(ASPECTS))
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='Comma-separated scenarios: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=3, help='Images processed per measurement')
+    parser.add_argument('--workers', type=int, default=1, help='Workers for the cli scenario')
+    parser.add_argument('--exact', action='store_true', help='Benchmark the exact (no shrink-on-load) path')
+    parser.add_argument('--output', help='Write results JSON here (default: stdout)')
+    parser.add_argument('--baseline', help='Earlier results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Slowdown vs baseline that counts as a regression (default 0.10)')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    parser.add_argument('--make-corpus', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return
+    if args.make_corpus:
+        job = json.loads(args.make_corpus)
+        print(json.dumps(make_corpus(job['directory'], job['megapixels'], job['formats'], job['aspects'])))
+        return
+
+    from PIL import __version__ as pillow_version
+
+    spec = {'exact': args.exact}
+    corpus_dir = tempfile.mkdtemp(prefix='bench-corpus-')
+    try:
+        corpus = run_isolated('--make-corpus', {
+            'directory': corpus_dir, 'megapixels': PROFILES[args.profile],
+            'formats': args.formats.split(','), 'aspects': args.aspects.split(',')})
+        if isinstance(corpus, dict):
+            raise SystemExit(f"Could not create test images: {corpus['error']}")
+        results = []
+        for scenario in args.scenarios.split(','):
+            for image in corpus:
+                job = {'scenario': scenario, 'image': image, 'repeat': args.repeat,
+                       'spec': spec, 'workers': args.workers}
+                result = run_isolated('--run-one', job)
+                result.update({'scenario': scenario, 'image': {k: v for k, v in image.items() if k != 'path'}})
+                results.append(result)
+                rate = f"{result['images_per_sec']:.2f} images/sec" if 'images_per_sec' in result else result['error']
+                print(f"{scenario:7} {image['id']:28} {rate}", file=sys.stderr)
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pillow': pillow_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'profile': args.profile,
+            'repeat': args.repeat,
+            'workers': args.workers,
+            'spec': spec,
+            'stages_note': STAGES_NOTE,
+        },
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report['regressions'] = regressions
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
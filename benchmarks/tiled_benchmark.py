@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Tiled Resize Benchmark
+Compare peak memory and time of resizing a very large TIFF whole and in bands
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageChops
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_processing import build_pipeline
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def run(path, output, tiled, exact, results):
+    """Process path in this (fresh) process and report time and peak RSS in MB."""
+    start = time.perf_counter()
+    build_pipeline(tiled=tiled, exact=exact, format='PNG').process_file(path, output)
+    elapsed = time.perf_counter() - start
+    results.put((elapsed, peak_rss()))
+
+
+def peak_rss():
+    """Peak resident memory of this process in MB."""
+    try:
+        # Unlike ru_maxrss, VmHWM is not inherited across the fork and exec that started us
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tiled resizing of a large TIFF')
+    parser.add_argument('--megapixels', type=float, default=100, help='Size of the generated TIFF')
+    parser.add_argument('--compression', default='tiff_lzw',
+                        help='TIFF compression (raw, tiff_lzw, tiff_deflate, jpeg, packbits)')
+    parser.add_argument('--tile', type=int, default=0, help='Save in square tiles of this size instead of strips')
+    parser.add_argument('--exact', action='store_true', help='Resample without reducing_gap')
+    parser.add_argument('--tolerance', type=int, default=2, help='Largest allowed pixel difference')
+    args = parser.parse_args()
+
+    Image.MAX_IMAGE_PIXELS = None
+    width = int((args.megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    # Smooth but non-trivial content: upscaled noise
+    image = Image.effect_noise((width // 32, height // 32), 64).convert('RGB').resize(
+        (width, height), Image.Resampling.BILINEAR)
+
+    # Each run starts a fresh interpreter so its peak RSS is its own
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'large.tif')
+        options = {'compression': None if args.compression == 'raw' else args.compression}
+        if args.tile:
+            options['tile'] = (args.tile, args.tile)
+        image.save(path, **options)
+        del image
+        print(f'{width}x{height} TIFF ({args.compression}), {os.path.getsize(path) / 2**20:.0f}MB on disk')
+
+        outputs = {}
+        for tiled in (False, True):
+            outputs[tiled] = os.path.join(tmp, f'tiled-{tiled}.png')
+            results = context.Queue()
+            process = context.Process(target=run, args=(path, outputs[tiled], tiled, args.exact, results))
+            process.start()
+            elapsed, peak = results.get()
+            process.join()
+            print(f'{"bands" if tiled else "whole"}: {elapsed:6.2f}s  peak RSS {peak:6.0f}MB')
+
+        with Image.open(outputs[False]) as whole, Image.open(outputs[True]) as bands:
+            difference = max(high for _, high in ImageChops.difference(whole, bands).getextrema())
+        print(f'max pixel difference: {difference}')
+    if difference > args.tolerance:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+File Discovery
+Stream the image files of a directory tree as they are found
+"""
+
+import fnmatch
+import os
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.tiff')
+
+
+def _matches(path, patterns):
+    return any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+def is_selected(relative, include=None, exclude=None):
+    """
+    Whether iter_image_files would yield this path with these patterns.
+
+    Args:
+        relative: Path relative to the root, with "/" separators
+        include: Glob patterns, as for iter_image_files
+        exclude: Glob patterns, as for iter_image_files; also tested against
+                 each directory above the file
+
+    Returns:
+        bool
+    """
+    parts = relative.split('/')
+    for depth in range(1, len(parts) + 1):
+        if _matches('/'.join(parts[:depth]), exclude or ()):
+            return False
+    return not include or _matches(relative, include)
+
+
+def iter_image_files(root, recursive=False, include=None, exclude=None, skip=None):
+    """
+    Yield the image files under root, one at a time, while walking.
+
+    Built on os.scandir, whose entries already carry their file type, so no
+    stat call is made per file and nothing is collected up front: the first
+    image is yielded as soon as it is found, whatever the size of the tree.
+
+    Args:
+        root: Directory to walk
+        recursive: Descend into subdirectories
+        include: Glob patterns; if given, only files whose path relative to
+                 root matches one of them are yielded (e.g. "*.jpg", "2024/*")
+        exclude: Glob patterns for files and directories to leave out
+                 (e.g. "*/thumbs", "*_raw.tiff")
+        skip: Directory not to descend into, such as an output directory
+              inside root
+
+    Yields:
+        Path relative to root, with "/" separators
+    """
+    include = list(include or ())
+    exclude = list(exclude or ())
+    skip = os.path.realpath(skip) if skip else None
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as it:
+            for entry in it:
+                relative = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                if _matches(relative, exclude):
+                    continue
+                # Symlinked directories are not followed, so a link cannot make a loop
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and os.path.realpath(entry.path) != skip:
+                        stack.append(relative)
+                elif (entry.name.lower().endswith(IMAGE_EXTENSIONS)
+                      and (not include or _matches(relative, include))):
+                    yield relative
@@ -1,9 +1,10 @@
 from flask import Flask, request, jsonify, send_file
 from werkzeug.utils import secure_filename
 import os
-from PIL import Image
 import io
 
+from image_processing import PreflightError, build_pipeline, probe
+
 app = Flask(__name__, static_folder='static')
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'tiff'}
@@ -11,20 +12,10 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'tiff'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_image(image):
-    # Resize to 1200px width while maintaining aspect ratio
-    original_width, original_height = image.size
-    new_width = 1200
-    new_height = int((new_width / original_width) * original_height)
-    
-    # Resize the image
-    resized_img = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    # Add 1-pixel black border
-    bordered_img = Image.new('RGB', (new_width + 2, new_height + 2), (0, 0, 0))
-    bordered_img.paste(resized_img, (1, 1))
-    
-    return bordered_img
+def process_image(file, exact=False):
+    probe(file)  # reject non-images and oversized images from the header
+    # Resize to 1200px width while maintaining aspect ratio, add 1-pixel black border and encode
+    return build_pipeline(exact=exact).process_bytes(file)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -40,13 +31,7 @@ def upload_file():
     
     try:
         # Process the image
-        img = Image.open(file)
-        processed_img = process_image(img)
-        
-        # Save to BytesIO
-        img_io = io.BytesIO()
-        processed_img.save(img_io, 'JPEG', quality=95)
-        img_io.seek(0)
+        img_io = io.BytesIO(process_image(file.stream, request.form.get('exact', 'false').lower() == 'true'))
         
         # Create response
         return send_file(
@@ -56,6 +41,8 @@ def upload_file():
             download_name=f'processed_{secure_filename(file.filename)}'
         )
         
+    except PreflightError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
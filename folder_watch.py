@@ -0,0 +1,260 @@
+"""
+Folder Watch
+Report image files in a directory tree as soon as they have finished being written
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from discovery import IMAGE_EXTENSIONS, is_selected, iter_image_files
+
+# A file is ready once nothing has happened to it for this long
+SETTLE_SECONDS = 0.5
+
+# How often the polling fallback looks at the tree
+POLL_INTERVAL = 0.5
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; followed by len bytes of name
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch  # present since glibc 2.9
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+class InotifyWatcher:
+    """
+    Changed files under a directory, from the kernel's inotify events.
+
+    Nothing is scanned after start-up: each event names the file it is about.
+    Directories created later are watched as they appear (when recursive),
+    and if the kernel's event queue overflows the whole tree is reported once.
+    """
+
+    def __init__(self, root, recursive=False, skip=None):
+        self.root = root
+        self.recursive = recursive
+        self.skip = os.path.realpath(skip) if skip else None
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}  # watch descriptor -> directory relative to root ('' for root)
+        self._pending = set()
+        self._add_tree('')
+
+    def _add(self, relative):
+        path = os.path.join(self.root, relative) if relative else self.root
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+        self.dirs[wd] = relative
+
+    def _add_tree(self, relative):
+        """Watch a directory (and, when recursive, those below it)."""
+        self._add(relative)
+        if not self.recursive:
+            return
+        stack = [relative]
+        while stack:
+            current = stack.pop()
+            with os.scandir(os.path.join(self.root, current) if current else self.root) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False) and os.path.realpath(entry.path) != self.skip:
+                        child = f'{current}/{entry.name}' if current else entry.name
+                        self._add(child)
+                        stack.append(child)
+
+    def changes(self, timeout):
+        """
+        Wait up to timeout seconds for activity.
+
+        Returns:
+            Set of file paths, relative to root with "/" separators, that were
+            created, written, closed or moved in
+        """
+        changed, self._pending = self._pending, set()
+        if not select.select([self.fd], [], [], 0 if changed else timeout)[0]:
+            return changed
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                changed.update(iter_image_files(self.root, self.recursive, skip=self.skip))
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None or not name:
+                continue
+            name = os.fsdecode(name)
+            relative = f'{directory}/{name}' if directory else name
+            if mask & IN_ISDIR:
+                path = os.path.join(self.root, *relative.split('/'))
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO) and os.path.realpath(path) != self.skip:
+                    try:
+                        self._add_tree(relative)
+                    except OSError:
+                        continue
+                    # Files can land in a new directory before its watch exists
+                    self._pending.update(f'{relative}/{found}' for found in
+                                         iter_image_files(path, True, skip=self.skip))
+                continue
+            changed.add(relative)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Changed files under a directory, found by comparing scandir snapshots.
+
+    The fallback where inotify is not available (Windows, macOS, some
+    network filesystems): each poll walks the tree and stats every image.
+    """
+
+    def __init__(self, root, recursive=False, skip=None, interval=POLL_INTERVAL):
+        self.root = root
+        self.recursive = recursive
+        self.skip = skip
+        self.interval = interval
+        self.snapshot = self._scan()
+        self._next = time.monotonic()
+
+    def _scan(self):
+        snapshot = {}
+        for relative in iter_image_files(self.root, self.recursive, skip=self.skip):
+            try:
+                stat = os.stat(os.path.join(self.root, *relative.split('/')))
+            except OSError:
+                continue
+            snapshot[relative] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds, then report files that are new or changed since the last poll."""
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self._next = time.monotonic() + self.interval
+        snapshot = self._scan()
+        changed = {path for path, state in snapshot.items() if self.snapshot.get(path) != state}
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(root, recursive=False, skip=None, poll_interval=None):
+    """
+    An inotify watcher for root, or a polling one where inotify is not available.
+
+    Args:
+        root: Directory to watch
+        recursive: Include subdirectories
+        skip: Directory not to watch, such as an output directory inside root
+        poll_interval: Poll every this many seconds instead of using inotify
+    """
+    if poll_interval is None and _libc is not None:
+        try:
+            return InotifyWatcher(root, recursive, skip)
+        except OSError:
+            pass  # e.g. out of watches (fs.inotify.max_user_watches)
+    return PollingWatcher(root, recursive, skip, poll_interval or POLL_INTERVAL)
+
+
+def watch(root, recursive=False, include=None, exclude=None, skip=None, settle=SETTLE_SECONDS,
+          poll_interval=None, existing=True, stop=None):
+    """
+    Yield each image file under root once it has finished being written.
+
+    A file counts as finished when it has seen no activity for `settle`
+    seconds and its size and modification time did not change over that
+    time, so a file that is still being copied in is not handed over half
+    written. A file written again later is yielded again.
+
+    Args:
+        root: Directory to watch
+        recursive: Include subdirectories
+        include: Glob patterns a file's relative path must match (see discovery)
+        exclude: Glob patterns of files and directories to ignore
+        skip: Directory to ignore, such as an output directory inside root
+        settle: Seconds of quiet before a file is considered complete
+        poll_interval: Poll every this many seconds instead of using inotify
+        existing: Also yield the files already present when watching starts
+        stop: Callable; the generator returns once it is true
+
+    Yields:
+        Path relative to root with "/" separators, or None about every tenth
+        of a second while nothing is ready, so the caller can do other work
+    """
+    watcher = open_watcher(root, recursive, skip, poll_interval)
+    quiet = {}  # relative path -> (time of last activity, (size, mtime) then)
+    try:
+        if existing:
+            now = time.monotonic()
+            for relative in iter_image_files(root, recursive, include, exclude, skip=skip):
+                quiet[relative] = (now - settle, None)
+        while not (stop and stop()):
+            now = time.monotonic()
+            for relative in watcher.changes(0.1):
+                if relative.lower().endswith(IMAGE_EXTENSIONS) and is_selected(relative, include, exclude):
+                    quiet[relative] = (now, None)
+            now = time.monotonic()
+            ready = False
+            for relative, (last, state) in list(quiet.items()):
+                if now - last < settle:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, *relative.split('/')))
+                except OSError:
+                    del quiet[relative]  # gone, or moved away
+                    continue
+                current = (stat.st_size, stat.st_mtime_ns)
+                if current != state:
+                    # First look, or still growing: check again after another settle period
+                    quiet[relative] = (now - settle / 2 if state is None else now, current)
+                    continue
+                del quiet[relative]
+                ready = True
+                yield relative
+            if not ready:
+                yield None
+    finally:
+        watcher.close()
@@ -0,0 +1,56 @@
+"""
+Gunicorn Configuration
+Worker processes, threads and timeouts for app.py, sized from the CPU count and the memory budget
+
+Gunicorn loads ./gunicorn.conf.py on its own; the Procfile and render.yaml also
+name it explicitly. Every value can be overridden with the environment
+variables below or on the gunicorn command line. Check a change with
+benchmarks/load_test.py.
+"""
+
+import math
+import os
+
+from image_processing import ImageInfo, estimate_memory
+
+# The image a request is assumed to carry when sizing the server: a 24MP photo
+# that shrink-on-load cannot help with (PNG, TIFF or WebP), at the /upload settings
+TYPICAL_MEGAPIXELS = float(os.environ.get('GUNICORN_TYPICAL_MEGAPIXELS', 24))
+_typical_width = int((TYPICAL_MEGAPIXELS * 1_000_000 * 3 / 2) ** 0.5)
+_typical_image = ImageInfo('PNG', _typical_width, _typical_width * 2 // 3, 'RGB', 1)
+PER_IMAGE_BYTES = estimate_memory(_typical_image, {'width': 1200, 'border': 1})  # see UPLOAD_SPEC in app.py
+
+# Same setting and default as the memory budget in app.py
+MEMORY_BUDGET_BYTES = int(os.environ.get('MEMORY_BUDGET_MB', 2048)) * 1024 * 1024
+
+# How many typical images the budget lets the whole instance process at once
+IMAGES_IN_BUDGET = max(MEMORY_BUDGET_BYTES // PER_IMAGE_BYTES, 1)
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Threaded workers: a thread spends most of an upload waiting on the network
+# or on the memory budget, and Pillow releases the GIL while it decodes,
+# resamples and encodes, so threads also share the CPUs for ?sync=1 and
+# streamed uploads. Queued uploads are processed by the JOB_WORKERS pool.
+worker_class = 'gthread'
+
+# One process per core for the in-request processing, but no more than the
+# budget has room for, and at least two so a restart never leaves the
+# instance without a worker
+workers = int(os.environ.get('WEB_CONCURRENCY', 0)) or max(2, min(os.cpu_count() or 1, IMAGES_IN_BUDGET))
+
+# Enough threads that together the workers can hold as many requests as the
+# budget can process at once (the rest wait for room in the budget rather
+# than for a thread); status polls and result downloads are cheap
+threads = int(os.environ.get('GUNICORN_THREADS', 0)) or max(4, min(8, math.ceil(IMAGES_IN_BUDGET / workers)))
+
+# A gthread worker keeps answering the arbiter while its threads are busy,
+# so this only catches a worker that is truly stuck. Long uploads (up to
+# MAX_UPLOAD_MB) are not cut off by it, unlike the default sync worker.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+# Time for requests in flight, such as a ?sync=1 batch, to finish on restart
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 60))
+
+# Browsers poll /jobs/<id> every half second while a job runs
+keepalive = 5
@@ -0,0 +1,994 @@
+"""
+Image Processing Core
+One engine for every entry point: a pipeline of stages built from a declarative spec
+"""
+
+import io
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from PIL import Image, ImageOps, TiffImagePlugin, TiffTags
+
+try:
+    from PIL import ImageCms
+except ImportError:  # Pillow built without LittleCMS: profiles are kept or dropped, never converted
+    ImageCms = None
+
+# Pillow's reduce() runs until the image is within this factor of the target size
+REDUCING_GAP = 2.0
+
+# A rendition is resampled from an earlier, larger one if that is at least this much wider
+CASCADE_RATIO = 2.0
+
+# With 'tiled': 'auto', sources of at least this many pixels are read and
+# resized band by band where the format allows it (see resize_tiled)
+TILED_MIN_PIXELS = 40_000_000
+
+# Source rows decoded at a time in tiled mode
+TILE_ROWS = 512
+
+# Modes resize_tiled handles; anything else is decoded whole
+_TILED_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK')
+
+# Radius of Pillow's LANCZOS filter, in source pixels at scale 1
+_LANCZOS_SUPPORT = 3.0
+
+# TIFF tags holding offsets into the file, which a band copy cannot carry over
+_TIFF_POINTER_TAGS = (330, 34665, 34853, 40965)
+
+# Output format -> file extension
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+# Bytes per pixel Pillow stores these modes in; every other mode takes 4
+_MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2}
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# EXIF orientation -> transpose that makes the image upright (as in ImageOps.exif_transpose)
+_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+DEFAULT_SPEC = {
+    'stages': ['decode', 'orient', 'resize', 'border', 'normalize', 'encode'],
+    'width': 1200,
+    'border': 1,
+    'border_color': (0, 0, 0),
+    # 'expand': the whole picture, framed by the border on a larger canvas;
+    # 'inset' (opt-in, crops): the picture is scaled to the bordered size and
+    # its outermost `border` pixels are cut off to make room for the frame
+    'border_mode': 'expand',
+    'format': 'JPEG',
+    'quality': 95,
+    'optimize': False,
+    # 'standard': use quality/optimize/progressive as given; 'fast': skip the
+    # optimisation passes; 'small': progressive + optimize (smallest JPEG)
+    'encoder': 'standard',
+    'progressive': False,
+    # JPEG chroma subsampling ('4:4:4', '4:2:2', '4:2:0'); None is Pillow's default
+    'subsampling': None,
+    # Largest acceptable output; quality is binary-searched between
+    # min_quality and quality in at most target_iterations encodes
+    'target_bytes': None,
+    'min_quality': 40,
+    'target_iterations': 6,
+    'exact': False,
+    # Colour that transparent areas are flattened onto
+    'background': (255, 255, 255),
+    # Embedded ICC profile: 'keep' it in the output, convert the pixels to
+    # 'srgb' (and embed none), or 'drop' it
+    'icc': 'keep',
+    # Widths of several renditions to make from one decode; None means just 'width'
+    'sizes': None,
+    # Read and resize the source in bands of TILE_ROWS rows, so memory is
+    # bounded by the band rather than the image: True, False, or 'auto' for
+    # sources of TILED_MIN_PIXELS or more. Only strip- or tile-organised TIFFs
+    # can be read this way; other sources are decoded whole as usual.
+    'tiled': 'auto',
+}
+
+# Pre-flight limits checked against the image header before anything is decoded
+DEFAULT_LIMITS = {
+    'max_pixels': 80_000_000,
+    'max_side': 30_000,
+}
+
+# Held while Image.MAX_IMAGE_PIXELS is lifted for one Image.open (see _open)
+_OPEN_LOCK = threading.Lock()
+
+# Leading bytes of each supported input format (WebP also has b'WEBP' at offset 8)
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'II*\x00', 'TIFF'),
+    (b'MM\x00*', 'TIFF'),
+    (b'RIFF', 'WEBP'),
+)
+
+# What probe() learns from an image header; `banded` means the pixel data can
+# be read a band of rows at a time (see resize_tiled)
+ImageInfo = namedtuple('ImageInfo', ['format', 'width', 'height', 'mode', 'frames', 'banded'],
+                       defaults=(False,))
+
+# name -> stage function; each stage takes and updates the context dict
+STAGES = {}
+
+# tuple of adjacent stage names -> stage function that does all of them at once
+FUSED_STAGES = {}
+
+
+def stage(name, fuses=None):
+    """
+    Register a pipeline stage.
+
+    Args:
+        name: Name used in a spec's 'stages' list
+        fuses: Tuple of adjacent stage names this function replaces when they
+               appear together, e.g. ('resize', 'border')
+    """
+    def register(func):
+        STAGES[name] = func
+        if fuses:
+            FUSED_STAGES[tuple(fuses)] = func
+        return func
+    return register
+
+
+class PreflightError(ValueError):
+    """Raised when an image is rejected from its header, before decoding."""
+
+
+def _open(source, **kwargs):
+    """
+    Image.open without Pillow's own decompression-bomb limit (about 179MP).
+
+    Only for sources probe() is checking, or has accepted, against
+    DEFAULT_LIMITS or the caller's limits, so that raising those (e.g. with
+    --max-megapixels) is all it takes to accept a larger image.
+    """
+    with _OPEN_LOCK:
+        limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+        try:
+            return Image.open(source, **kwargs)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+
+def sniff_format(header):
+    """
+    Identify a supported image format from its first bytes.
+
+    Args:
+        header: At least the first 12 bytes of the file
+
+    Returns:
+        Pillow format name, or None if the content is not a supported image
+    """
+    for signature, name in SIGNATURES:
+        if header.startswith(signature):
+            if name == 'WEBP' and header[8:12] != b'WEBP':
+                return None
+            return name
+    return None
+
+
+def probe(source, limits=None):
+    """
+    Describe an image from its header alone and check it against limits.
+
+    Nothing is decoded, so a mislabelled file or a decompression bomb costs
+    microseconds instead of a full decode. A file object is left at the
+    position it was in.
+
+    Args:
+        source: Path or seekable file object
+        limits: dict overriding DEFAULT_LIMITS
+
+    Returns:
+        ImageInfo
+
+    Raises:
+        PreflightError: If the content is not a supported image or exceeds a limit
+    """
+    limits = dict(DEFAULT_LIMITS, **(limits or {}))
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return probe(f, limits)
+
+    position = source.tell()
+    try:
+        format_name = sniff_format(source.read(16))
+        if format_name is None:
+            raise PreflightError('Not a supported image (unrecognised content)')
+        source.seek(position)
+        try:
+            # Our own limits apply, below
+            image = _open(source, formats=[format_name])
+            frames = getattr(image, 'n_frames', 1)
+        except Exception as e:
+            raise PreflightError(f'Unreadable {format_name} header: {e}')
+        info = ImageInfo(format_name, image.width, image.height, image.mode, frames,
+                         _tiff_blocks(image) is not None)
+    finally:
+        source.seek(position)
+
+    if info.width * info.height > limits['max_pixels']:
+        raise PreflightError(f'Image is {info.width}x{info.height} '
+                             f'({info.width * info.height / 1e6:.0f}MP); '
+                             f'the limit is {limits["max_pixels"] / 1e6:.0f}MP')
+    if max(info.width, info.height) > limits['max_side']:
+        raise PreflightError(f'Image is {info.width}x{info.height}; '
+                             f'sides are limited to {limits["max_side"]}px')
+    return info
+
+
+def _jpeg_draft_scale(info, width):
+    """
+    Largest DCT scale (1, 2, 4 or 8) draft() can shrink a JPEG by for this
+    target, taking the smaller of the upright and rotated cases.
+    """
+    scales = []
+    for orientation in (1, 6):
+        out_width, out_height = target_size((info.width, info.height), width, orientation)
+        if orientation in _TRANSPOSED_ORIENTATIONS:
+            out_width, out_height = out_height, out_width
+        scale = 1
+        while (scale < 8 and info.width / (scale * 2) >= out_width * 2
+               and info.height / (scale * 2) >= out_height * 2):
+            scale *= 2
+        scales.append(scale)
+    return min(scales)
+
+
+def estimate_memory(info, spec=None):
+    """
+    Rough peak memory, in bytes, of processing an image, from its header alone.
+
+    Counts the decoded image after shrink-on-load, the full-size copy made
+    for modes that are converted before resampling (see _resizable), the
+    reduce() and first-pass intermediates of the resize, and a few
+    output-sized images per rendition for the border, normalize and encode
+    steps. Pillow keeps most modes at 4 bytes per pixel, and the estimate
+    errs on the high side. Sources resized in bands (see resize_tiled) only
+    count one band of source rows and the narrowed rows it leaves behind.
+
+    Args:
+        info: ImageInfo from probe
+        spec: Processing settings overriding DEFAULT_SPEC
+
+    Returns:
+        Estimated bytes
+    """
+    spec = dict(DEFAULT_SPEC, **(spec or {}))
+    width = _largest_width(spec)
+    tiled = spec['tiled']
+    if info.banded and tiled and (tiled is True or info.width * info.height >= TILED_MIN_PIXELS):
+        decoded_width, decoded_height = info.width, info.height
+        out_width, out_height = target_size((info.width, info.height), width)
+        # A band as read (raw bytes and decoded), plus the narrowed rows and the output
+        total = info.width * TILE_ROWS * 4 * 2 + out_width * (TILE_ROWS + out_height) * 4 * 2
+    else:
+        scale = _jpeg_draft_scale(info, width) if info.format == 'JPEG' and not spec['exact'] else 1
+        decoded_width, decoded_height = -(-info.width // scale), -(-info.height // scale)
+        pixels = decoded_width * decoded_height
+
+        total = pixels * _MODE_BYTES.get(info.mode, 4)
+        if info.mode in ('1', 'P', 'PA'):
+            total += pixels * 4
+        factor = 1 if spec['exact'] else max(int(decoded_width / width / REDUCING_GAP), 1)
+        if factor > 1:
+            total += pixels // (factor * factor) * 4
+        total += width * (decoded_height // factor) * 4
+    for size in spec['sizes'] or [spec['width']]:
+        out_width, out_height = target_size((decoded_width, decoded_height), size)
+        total += (out_width + 2 * spec['border']) * (out_height + 2 * spec['border']) * 4 * 3
+    return total
+
+
+def add_border(image, border_width=1, border_color=(0, 0, 0)):
+    """
+    Add a border to the image.
+
+    Args:
+        image: PIL Image object
+        border_width: Width of the border in pixels
+        border_color: RGB tuple or colour name for the border (default is black)
+
+    Returns:
+        PIL Image object with border
+    """
+    width, height = image.size
+    new_width = width + border_width * 2
+    new_height = height + border_width * 2
+
+    bordered_image = Image.new('RGB', (new_width, new_height), border_color)
+    bordered_image.paste(image, (border_width, border_width))
+    return bordered_image
+
+
+def target_size(size, width, orientation=1):
+    """
+    Output size for an image scaled to `width` while maintaining aspect ratio.
+
+    Args:
+        size: (width, height) of the stored image
+        width: Target width
+        orientation: EXIF orientation; 5-8 mean the displayed image is rotated
+
+    Returns:
+        (width, height) tuple
+    """
+    original_width, original_height = size
+    if orientation in _TRANSPOSED_ORIENTATIONS:
+        original_width, original_height = original_height, original_width
+    return width, int((width / original_width) * original_height)
+
+
+def _orientation(image):
+    try:
+        return image.getexif().get(0x0112, 1)
+    except Exception:
+        return 1
+
+
+def _resizable(image):
+    """
+    Convert modes that Pillow can only resample with NEAREST ('1', 'P', 'PA').
+
+    This is the one conversion that has to happen at full resolution; every
+    other mode is resampled as it is and converted at the output size.
+    """
+    if image.mode == '1':
+        return image.convert('L')
+    if image.mode in ('P', 'PA'):
+        return image.convert('RGBA' if image.mode == 'PA' or 'transparency' in image.info else 'RGB')
+    return image
+
+
+def _to_rgb(context, image):
+    """
+    Convert a resampled image to RGB, flattening any alpha onto spec['background'].
+
+    A CMYK image is converted through its embedded profile where LittleCMS is
+    available; either way context['icc_profile'] is updated, since a CMYK
+    profile does not describe the RGB result.
+    """
+    if image.mode == 'RGB':
+        return image
+    if image.mode == 'CMYK':
+        profile = context.get('icc_profile')
+        context['icc_profile'] = None
+        if profile and ImageCms is not None:
+            try:
+                return ImageCms.profileToProfile(image, ImageCms.ImageCmsProfile(io.BytesIO(profile)),
+                                                 ImageCms.createProfile('sRGB'), outputMode='RGB')
+            except ImageCms.PyCMSError:
+                pass
+        return image.convert('RGB')
+    if image.mode in ('RGBA', 'LA', 'RGBa', 'La'):
+        rgba = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, context['spec']['background'])
+        flat.paste(rgba, mask=rgba.getchannel('A'))
+        return flat
+    return image.convert('RGB')
+
+
+def _resize_target(context, width):
+    """
+    Size to resample the stored image to so that it is `width` wide once upright.
+
+    When the EXIF orientation is deferred to the normalize stage, the stored
+    image is still on its side, so width and height are swapped.
+    """
+    orientation = context.get('orientation', 1)
+    new_width, new_height = target_size(context['image'].size, width, orientation)
+    if orientation in _TRANSPOSED_ORIENTATIONS:
+        return new_height, new_width
+    return new_width, new_height
+
+
+def _resize(image, size, exact, box=None, tiled=False):
+    if tiled:
+        return resize_tiled(image, size)
+    return image.resize(size, Image.Resampling.LANCZOS, box=box,
+                        reducing_gap=None if exact else REDUCING_GAP)
+
+
+def _tiff_blocks(image):
+    """
+    How a TIFF's pixel data is split into separately decodable blocks.
+
+    Strips are blocks of rows; tiles come a row of tiles at a time. An
+    uncompressed image stored as a single strip is split into virtual
+    strips, since its rows can be addressed directly.
+
+    Returns:
+        (rows per block, offsets, byte counts, offsets per block, offsets
+        tag, byte counts tag), or None if the image cannot be read in bands
+    """
+    if image.format != 'TIFF' or image.mode not in _TILED_MODES:
+        return None
+    tags = image.tag_v2
+    if tags.get(284, 1) != 1:  # planes stored separately
+        return None
+    if 324 in tags:
+        return (tags[323], tags[324], tags[325], -(-image.width // tags[322]), 324, 325)
+    if 273 not in tags:
+        return None
+    rows, offsets, counts = tags.get(278, image.height), tags[273], tags[279]
+    if len(offsets) == 1 and tags.get(259, 1) == 1:
+        stride = -(-image.width * sum(tags.get(258, (8,))) // 8)
+        rows = max(TILE_ROWS // 4, 1)
+        offsets = [offsets[0] + top * stride for top in range(0, image.height, rows)]
+        counts = [min(rows, image.height - top) * stride for top in range(0, image.height, rows)]
+    if len(offsets) < 2:
+        return None
+    return rows, offsets, counts, 1, 273, 279
+
+
+def _read_tiff_rows(image, blocks, start, stop):
+    """
+    Decode blocks start..stop of a TIFF (see _tiff_blocks) as an image of its own.
+
+    The blocks' bytes are copied into a small in-memory TIFF with the same
+    tags, so Pillow (or libtiff) decodes just those rows.
+
+    Returns:
+        Loaded image covering rows start * rows_per_block onwards
+    """
+    rows, offsets, counts, per_block, offsets_tag, counts_tag = blocks
+    tags = image.tag_v2
+    endian = '<' if tags.prefix == b'II' else '>'
+    first, last = start * per_block, min(stop * per_block, len(offsets))
+    band_counts = list(counts[first:last])
+
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=tags.prefix)
+    for tag, value in tags.items():
+        if tag not in _TIFF_POINTER_TAGS:
+            ifd[tag] = value
+            ifd.tagtype[tag] = tags.tagtype[tag]
+    ifd[257] = min(stop * rows, image.height) - start * rows
+    if offsets_tag == 273:
+        ifd[278] = rows
+    for tag in (offsets_tag, counts_tag):
+        ifd[tag] = 0  # placeholders, patched below
+        ifd.tagtype[tag] = TiffTags.LONG
+    directory = bytearray(ifd.tobytes(8))
+    directory += b'\0' * (len(directory) % 2)
+    arrays = 8 + len(directory)
+    data = arrays + 8 * len(band_counts)
+    band_offsets = [data + sum(band_counts[:i]) for i in range(len(band_counts))]
+    # Pillow's writer only handles a single strip offset, so write the arrays ourselves
+    tag_order = sorted(ifd)
+    for tag, values, at in ((offsets_tag, band_offsets, arrays),
+                            (counts_tag, band_counts, arrays + 4 * len(band_counts))):
+        position = 2 + 12 * tag_order.index(tag)
+        directory[position:position + 12] = struct.pack(endian + 'HHII', tag, TiffTags.LONG, len(values),
+                                                        values[0] if len(values) == 1 else at)
+
+    band = io.BytesIO()
+    band.write(tags.prefix + struct.pack(endian + 'HI', 42, 8))
+    band.write(directory)
+    band.write(struct.pack(f'{endian}{len(band_offsets)}I', *band_offsets))
+    band.write(struct.pack(f'{endian}{len(band_counts)}I', *band_counts))
+    for i in range(first, last):
+        image.fp.seek(offsets[i])
+        band.write(image.fp.read(counts[i]))
+    band.seek(0)
+    decoded = Image.open(band)
+    decoded.load()
+    return decoded
+
+
+def resize_tiled(image, size, tile_rows=TILE_ROWS):
+    """
+    LANCZOS-resize a strip- or tile-organised TIFF without decoding all of it.
+
+    The source is decoded about tile_rows rows at a time and each band gets
+    the horizontal pass straight away; the vertical pass then makes each
+    band of output rows from just the (already narrow) rows its filter
+    reaches. The result matches image.resize(size, LANCZOS) to within one
+    level (the band offsets shift the filter positions by a rounding error),
+    while only one band of the full-width source is ever in memory.
+
+    Args:
+        image: TIFF opened with Image.open and not yet loaded
+        size: (width, height) to resize to
+        tile_rows: Source rows to decode at a time
+
+    Returns:
+        Resized image
+    """
+    blocks = _tiff_blocks(image)
+    if blocks is None:
+        return image.resize(size, Image.Resampling.LANCZOS)
+    width, height = image.size
+    rows_per_block = blocks[0]
+    scale = height / size[1]
+    support = _LANCZOS_SUPPORT * max(scale, 1.0)
+    band_rows = max(int((tile_rows - 2 * support) / scale), 1)
+    blocks_per_read = max(tile_rows // rows_per_block, 1)
+    # Image.resize works on premultiplied alpha; do the same so both passes share it
+    mode = {'RGBA': 'RGBa', 'LA': 'La'}.get(image.mode, image.mode)
+
+    result = Image.new(mode, size)
+    narrow = []  # (first source row, horizontally resized rows), in order
+    next_block = 0
+    for top in range(0, size[1], band_rows):
+        bottom = min(top + band_rows, size[1])
+        # Source rows the filter reaches for these output rows (as in Pillow's
+        # precompute_coeffs), plus one either side for rounding
+        first = max(int((top + 0.5) * scale - support + 0.5) - 1, 0)
+        last = min(int((bottom - 0.5) * scale + support + 0.5) + 1, height)
+        while not narrow or narrow[-1][0] + narrow[-1][1].height < last:
+            rows = _read_tiff_rows(image, blocks, next_block, next_block + blocks_per_read).convert(mode)
+            narrow.append((next_block * rows_per_block, rows.resize((size[0], rows.height),
+                                                                    Image.Resampling.LANCZOS)))
+            next_block += blocks_per_read
+        while narrow[0][0] + narrow[0][1].height <= first:
+            narrow.pop(0)
+
+        window = Image.new(mode, (size[0], last - first))
+        for start, rows in narrow:
+            window.paste(rows, (0, start - first))
+        box = (0, top * scale - first, size[0], min(bottom * scale - first, last - first))
+        result.paste(window.resize((size[0], bottom - top), Image.Resampling.LANCZOS, box=box), (0, top))
+    return result.convert(image.mode)
+
+
+def _largest_width(spec):
+    return max(spec['sizes']) if spec['sizes'] else spec['width']
+
+
+def output_extension(spec=None):
+    """File extension for the spec's output format."""
+    return FORMAT_EXTENSIONS[(spec or {}).get('format') or DEFAULT_SPEC['format']]
+
+
+def rendition_path(output_path, width):
+    """Output path for one rendition: photo.jpg -> photo_800.jpg."""
+    root, ext = os.path.splitext(output_path)
+    return f"{root}_{width}{ext}"
+
+
+def output_paths(output_path, spec=None):
+    """Every file a pipeline with this spec writes for output_path."""
+    sizes = (spec or {}).get('sizes')
+    if sizes:
+        return [rendition_path(output_path, width) for width in sorted(set(sizes), reverse=True)]
+    return [output_path]
+
+
+def _resize_source(context, width):
+    """
+    Pick the image (and region of it) to resample from.
+
+    When making several renditions, each one is derived from the smallest
+    earlier intermediate that is still CASCADE_RATIO times wider than the
+    target, instead of going back to the full decoded image every time.
+
+    Returns:
+        (image, box) for Image.resize
+    """
+    image, box = context['image'], None
+    if not context['spec']['exact']:
+        for candidate, candidate_box in context.get('intermediates', ()):
+            if candidate_box[2] - candidate_box[0] >= width * CASCADE_RATIO:
+                image, box = candidate, candidate_box
+    return image, box
+
+
+def _use_tiled(image, spec):
+    """Whether the spec asks for tiled reading of this source and it can be read that way."""
+    tiled = spec['tiled']
+    if not tiled or (tiled == 'auto' and image.width * image.height < TILED_MIN_PIXELS):
+        return False
+    return _tiff_blocks(image) is not None
+
+
+def _draft(image, spec):
+    """Unless exact, let the JPEG decoder shrink the image to within 2x of the target."""
+    if spec['exact']:
+        return
+    orientation = _orientation(image) if 'orient' in spec['stages'] else 1
+    new_width, new_height = target_size(image.size, _largest_width(spec), orientation)
+    if orientation in _TRANSPOSED_ORIENTATIONS:
+        new_width, new_height = new_height, new_width
+    image.draft(image.mode, (new_width * 2, new_height * 2))
+
+
+@stage('decode')
+def decode(context):
+    """
+    Open the source and shrink it on load.
+
+    Callers pre-flight sources with probe(), so Pillow's fixed pixel limit is
+    not applied on top of theirs.
+    """
+    image = _open(context['source'])
+    context['decoded'] = image
+    context['source_size'] = image.size
+    context['icc_profile'] = image.info.get('icc_profile')
+    if _use_tiled(image, context['spec']):
+        # Left unloaded; the resize reads it band by band
+        context['image'] = context['tiled'] = image
+        return
+    _draft(image, context['spec'])
+    # Decode now rather than lazily in the next stage, so timings are attributed correctly
+    image.load()
+    context['image'] = _resizable(image)
+
+
+@stage('orient')
+def orient(context):
+    """
+    Apply the EXIF orientation so the image is upright.
+
+    With a 'normalize' stage in the pipeline the rotation is only recorded
+    here: the resize targets the swapped size and normalize rotates the
+    small result instead of the full-resolution image.
+    """
+    orientation = _orientation(context['image'])
+    if orientation == 1:
+        return
+    if 'normalize' in context['spec']['stages']:
+        context['orientation'] = orientation
+    else:
+        context['image'] = ImageOps.exif_transpose(context['image'])
+
+
+@stage('resize')
+def resize(context):
+    """Scale to the spec's width while maintaining aspect ratio."""
+    spec = context['spec']
+    size = _resize_target(context, spec['width'])
+    image, box = _resize_source(context, size[0])
+    resized = _resize(image, size, spec['exact'], box, image is context.get('tiled'))
+    if 'intermediates' in context:
+        context['intermediates'].append((resized, (0, 0) + size))
+    context['image'] = resized
+
+
+@stage('border')
+def border(context):
+    """Frame the image with a solid border."""
+    spec = context['spec']
+    if spec['border']:
+        context['image'] = add_border(_to_rgb(context, context['image']), spec['border'],
+                                      spec['border_color'])
+
+
+@stage('normalize')
+def normalize(context):
+    """
+    Turn the processed image upright, into RGB and into the output colour space.
+
+    Runs after the resize, so the rotation, mode conversion, alpha flattening
+    and profile conversion all work on output-sized pixels.
+    """
+    spec = context['spec']
+    image = _to_rgb(context, context['image'])
+    profile = context.get('icc_profile')
+    if profile and spec['icc'] == 'srgb' and ImageCms is not None:
+        try:
+            image = ImageCms.profileToProfile(image, ImageCms.ImageCmsProfile(io.BytesIO(profile)),
+                                              ImageCms.createProfile('sRGB'), outputMode='RGB')
+            context['icc_profile'] = None
+        except ImageCms.PyCMSError:
+            pass
+    elif spec['icc'] != 'keep':
+        context['icc_profile'] = None
+    method = _ORIENTATION_TRANSPOSE.get(context.get('orientation', 1))
+    if method is not None:
+        image = image.transpose(method)
+    context['image'] = image
+
+
+@stage('resize_border', fuses=('resize', 'border'))
+def resize_border(context):
+    """
+    Resize and frame in one step.
+
+    The picture is resized into the box inside the frame and pasted onto a
+    canvas filled with the border colour; no pixel of it is painted over.
+    In 'inset' mode (never with exact) it is scaled as if to the full
+    bordered size and only the part that stays visible inside the frame is
+    resampled, cropping `border` pixels off each edge.
+    """
+    spec = context['spec']
+    border_width = spec['border']
+    new_width, new_height = _resize_target(context, spec['width'])
+    image, box = _resize_source(context, new_width)
+    tiled = image is context.get('tiled')
+
+    if border_width and not spec['exact'] and spec['border_mode'] == 'inset':
+        canvas_width, canvas_height = new_width + border_width * 2, new_height + border_width * 2
+        if tiled:  # banded resizing takes no box; crop the full-canvas result
+            resized = _resize(image, (canvas_width, canvas_height), False, tiled=True).crop(
+                (border_width, border_width, canvas_width - border_width, canvas_height - border_width))
+        else:
+            left, top, right, bottom = box or (0, 0) + image.size
+            dx = (right - left) * border_width / canvas_width
+            dy = (bottom - top) * border_width / canvas_height
+            resized = _resize(image, (new_width, new_height), False,
+                              (left + dx, top + dy, right - dx, bottom - dy))
+        # A cropped picture cannot stand in for the source of smaller renditions
+    else:
+        resized = _resize(image, (new_width, new_height), spec['exact'], box, tiled)
+        if context.get('intermediates') is not None:
+            context['intermediates'].append((resized, (0, 0, new_width, new_height)))
+    if border_width:
+        resized = add_border(_to_rgb(context, resized), border_width, spec['border_color'])
+    context['image'] = resized
+
+
+def encoder_options(spec, quality=None):
+    """
+    Keyword arguments for Image.save for the spec's format and encoder mode.
+
+    Args:
+        spec: Pipeline spec
+        quality: Quality to use instead of spec['quality']
+    """
+    quality = spec['quality'] if quality is None else quality
+    mode = spec['encoder']
+    if spec['format'] == 'WEBP':
+        # method trades encoder effort for size: 0 is fastest, 6 smallest
+        return {'quality': quality, 'method': {'fast': 0, 'small': 6}.get(mode, 4)}
+
+    options = {'quality': quality, 'optimize': spec['optimize'], 'progressive': spec['progressive']}
+    if mode == 'fast':
+        options.update(optimize=False, progressive=False)
+    elif mode == 'small':
+        options.update(optimize=True, progressive=True)
+    if spec['subsampling'] is not None:
+        options['subsampling'] = spec['subsampling']
+    return options
+
+
+def _encode_to_target(image, spec, extra):
+    """
+    Binary-search the highest quality whose output fits spec['target_bytes'].
+
+    The search never goes above spec['quality'], nor below spec['min_quality']
+    unless the requested quality is lower still.
+
+    Returns:
+        (encoded bytes, quality); the lowest quality tried if nothing fits
+    """
+    floor = min(spec['quality'], spec['min_quality'])
+    low, high = floor, spec['quality']
+    best = None
+    for _ in range(spec['target_iterations']):
+        if low > high:
+            break
+        quality = (low + high + 1) // 2
+        buffer = io.BytesIO()
+        image.save(buffer, spec['format'], **encoder_options(spec, quality), **extra)
+        if buffer.tell() <= spec['target_bytes']:
+            best = (buffer.getvalue(), quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        buffer = io.BytesIO()
+        image.save(buffer, spec['format'], **encoder_options(spec, floor), **extra)
+        best = (buffer.getvalue(), floor)
+    return best
+
+
+@stage('encode')
+def encode(context):
+    """
+    Save the image to context['output'] (a path or a file object).
+
+    Records the encoded size in context['output_bytes'] and the quality
+    used in context['quality'].
+    """
+    spec = context['spec']
+    image = context['image']
+    output = context['output']
+    if spec['format'] == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    extra = {'icc_profile': context['icc_profile']} if context.get('icc_profile') else {}
+
+    if spec['target_bytes']:
+        data, context['quality'] = _encode_to_target(image, spec, extra)
+        if isinstance(output, (str, os.PathLike)):
+            with open(output, 'wb') as f:
+                f.write(data)
+        else:
+            output.write(data)
+        context['output_bytes'] = len(data)
+        return
+
+    context['quality'] = spec['quality']
+    if isinstance(output, (str, os.PathLike)):
+        image.save(output, spec['format'], **encoder_options(spec), **extra)
+        context['output_bytes'] = os.path.getsize(output)
+    else:
+        start = output.tell()
+        image.save(output, spec['format'], **encoder_options(spec), **extra)
+        context['output_bytes'] = output.tell() - start
+
+
+def _fuse(names):
+    """
+    Replace runs of adjacent stages that have a fused implementation.
+
+    Returns:
+        List of (tuple of stage names, stage function)
+    """
+    stages = []
+    i = 0
+    while i < len(names):
+        for run, func in FUSED_STAGES.items():
+            if tuple(names[i:i + len(run)]) == run:
+                stages.append((run, func))
+                i += len(run)
+                break
+        else:
+            if names[i] not in STAGES:
+                raise ValueError(f"Unknown pipeline stage: {names[i]}")
+            stages.append(((names[i],), STAGES[names[i]]))
+            i += 1
+    return stages
+
+
+def _run_stages(stages, context):
+    """Run (names, func) stages in order, adding each one's duration to context['timings']."""
+    timings = context['timings']
+    for names, func in stages:
+        start = time.perf_counter()
+        func(context)
+        name = '+'.join(names)
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def _as_source(data):
+    return io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+
+
+def _report(context, info):
+    """
+    Copy what callers may want to record about a run into `info`: stage
+    'timings', 'source_size', total 'output_bytes' and the 'quality' used
+    (per width for renditions).
+    """
+    if info is None:
+        return
+    info['timings'] = context['timings']
+    info['source_size'] = context.get('source_size')
+    renditions = context.get('renditions')
+    if renditions:
+        info['output_bytes'] = sum(r.get('output_bytes', 0) for r in renditions.values())
+        info['quality'] = {width: r.get('quality') for width, r in renditions.items()}
+    else:
+        info['output_bytes'] = context.get('output_bytes')
+        info['quality'] = context.get('quality')
+
+
+class Pipeline:
+    """
+    A sequence of stages built from a spec (see DEFAULT_SPEC).
+
+    Every stage works on a shared context dict holding the spec, the source,
+    the current image and the output.
+    """
+
+    def __init__(self, spec=None, **overrides):
+        """
+        Args:
+            spec: dict of settings; missing keys come from DEFAULT_SPEC
+            **overrides: Individual settings that take precedence over spec
+        """
+        self.spec = dict(DEFAULT_SPEC)
+        self.spec.update(spec or {})
+        self.spec.update(overrides)
+        self.stages = _fuse(list(self.spec['stages']))
+
+    def run(self, source=None, output=None, image=None):
+        """
+        Run every stage and return the final context.
+
+        context['timings'] maps each stage name ('resize+border' for a fused
+        stage) to the seconds spent in it, summed over all renditions.
+
+        Args:
+            source: Path or file object to decode (for pipelines with 'decode')
+            output: Path or file object to encode into (for pipelines with 'encode')
+            image: Already decoded image (for pipelines without 'decode')
+        """
+        context = {'spec': self.spec, 'source': source, 'output': output, 'image': image,
+                   'timings': {}}
+        if not self.spec['sizes']:
+            _run_stages(self.stages, context)
+            return context
+
+        # Everything before the resize runs once; the rest runs per rendition
+        split = next((i for i, (names, _) in enumerate(self.stages) if 'resize' in names),
+                     len(self.stages))
+        _run_stages(self.stages[:split], context)
+        context['intermediates'] = []
+        context['renditions'] = {}
+        for width in sorted(set(self.spec['sizes']), reverse=True):
+            rendition = dict(context, spec=dict(self.spec, width=width),
+                             output=output[width] if output else io.BytesIO())
+            _run_stages(self.stages[split:], rendition)
+            context['renditions'][width] = rendition
+        del context['intermediates']
+        return context
+
+    def process_image(self, image):
+        """Run the stages between decode and encode on an open image."""
+        names = [n for n in self.spec['stages'] if n not in ('decode', 'encode')]
+        _draft(image, self.spec)
+        context = {'spec': self.spec, 'image': _resizable(image),
+                   'icc_profile': image.info.get('icc_profile')}
+        for _, func in _fuse(names):
+            func(context)
+        return context['image']
+
+    def process_file(self, input_path, output_path, info=None):
+        """
+        Decode input_path, process it and write the result to output_path.
+
+        With 'sizes' set, every rendition is written next to output_path
+        (see rendition_path).
+
+        Args:
+            input_path: Path of the source image
+            output_path: Path to write to
+            info: Optional dict that receives what the run recorded (see _report)
+        """
+        if self.spec['sizes']:
+            output_path = {width: rendition_path(output_path, width) for width in self.spec['sizes']}
+        context = self.run(source=input_path, output=output_path)
+        context['decoded'].close()
+        _report(context, info)
+
+    def process_bytes(self, data, info=None):
+        """
+        Process an encoded image and return the encoded result.
+
+        Args:
+            data: Encoded image bytes, or a readable file object (e.g. an mmap)
+            info: Optional dict that receives what the run recorded (see _report)
+        """
+        output = io.BytesIO()
+        context = self.run(source=_as_source(data), output=output)
+        context['decoded'].close()
+        _report(context, info)
+        return output.getvalue()
+
+    def process_renditions(self, data, info=None):
+        """
+        Make every rendition in 'sizes' from an encoded image.
+
+        Args:
+            data: Encoded image bytes, or a readable file object (e.g. an mmap)
+            info: Optional dict that receives what the run recorded (see _report)
+
+        Returns:
+            dict of width -> encoded bytes
+        """
+        context = self.run(source=_as_source(data))
+        context['decoded'].close()
+        _report(context, info)
+        return {width: rendition['output'].getvalue()
+                for width, rendition in context['renditions'].items()}
+
+
+def build_pipeline(spec=None, **overrides):
+    """Build a Pipeline from a declarative spec."""
+    return Pipeline(spec, **overrides)
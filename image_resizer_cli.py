@@ -4,96 +4,533 @@ Image Resizer CLI Tool
 Resize images to 1200px width, maintain aspect ratio, add border, and convert to JPG
 """
 
-from PIL import Image
 import os
 import sys
-import argparse
+import contextlib
+import io
+import time
 
-def add_border(image, border_width=1, border_color=(0, 0, 0)):
+# Everything else, Pillow included, is imported where it is used: a run that is
+# handed to the resize server (see resize_server) never loads it, and a single
+# file does not load the batch, watch and archive machinery.
+
+def __getattr__(name):
+    if name == 'add_border':  # re-exported for existing callers
+        from image_processing import add_border
+        return add_border
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def process_image_file(input_path, output_path, spec=None, reservation=None):
     """
-    Add a border to the image.
-    
+    Resize image to 1200 pixels wide while maintaining aspect ratio,
+    add a 1-pixel black border, and save as JPG.
+
+    Raises on failure; used by both the single-file and the batch paths.
+
     Args:
-        image: PIL Image object
-        border_width: Width of the border in pixels
-        border_color: RGB tuple for border color (default is black)
-    
+        input_path: Path to the input image
+        output_path: Path to save the processed image
+        spec: Processing settings overriding image_processing.DEFAULT_SPEC
+        reservation: memory_budget.Reservation held while the image is processed
+
     Returns:
-        PIL Image object with border
+        dict with the stage 'timings', 'output_bytes' and 'quality' used
     """
-    width, height = image.size
-    new_width = width + border_width * 2
-    new_height = height + border_width * 2
-    
-    bordered_image = Image.new('RGB', (new_width, new_height), border_color)
-    bordered_image.paste(image, (border_width, border_width))
-    return bordered_image
+    from image_processing import build_pipeline
+    info = {}
+    with reservation or contextlib.nullcontext():
+        build_pipeline(spec).process_file(input_path, output_path, info)
+    return info
 
-def resize_and_process_image(input_path, output_path):
+def read_image_file(input_path, output_path, spec=None, reservation=None):
+    """Read an input file into memory (the first step of the pipelined mode)."""
+    with open(input_path, 'rb') as f:
+        return f.read()
+
+def process_image_data(data, input_path, output_path, spec=None, reservation=None):
     """
-    Resize image to 1200 pixels wide while maintaining aspect ratio,
-    add a 1-pixel black border, and save as JPG.
+    Process an input read by read_image_file, without touching the disk.
+
+    Returns:
+        (dict of output path -> encoded bytes, info dict as from process_image_file)
+    """
+    from image_processing import build_pipeline, rendition_path
+    pipeline = build_pipeline(spec)
+    info = {}
+    with reservation or contextlib.nullcontext():
+        if pipeline.spec['sizes']:
+            outputs = {rendition_path(output_path, width): encoded
+                       for width, encoded in pipeline.process_renditions(data, info).items()}
+        else:
+            outputs = {output_path: pipeline.process_bytes(data, info)}
+    return outputs, info
+
+def write_image_outputs(result, input_path, output_path, spec=None, reservation=None):
+    """Write what process_image_data made, each file atomically; returns its info dict."""
+    from batch_processing import write_atomic
+    outputs, info = result
+    for path, encoded in outputs.items():
+        write_atomic(path, encoded)
+    return info
+
+def describe_success(input_path, output_path, spec, info):
+    """
+    "Successfully processed: in -> out (...)" line naming the files actually
+    written: the renditions, not output_path itself, when spec has sizes.
+    """
+    from image_processing import output_paths
+    return (f"Successfully processed: {input_path} -> {', '.join(output_paths(output_path, spec))} "
+            f"({describe_output(info)})")
+
+def describe_output(info):
+    """Short "123456 bytes, encode 12.3ms" note for a processed image."""
+    text = f"{info['output_bytes']} bytes, encode {info['timings'].get('encode', 0.0) * 1000:.1f}ms"
+    if isinstance(info['quality'], int) and info['quality']:
+        text += f", quality {info['quality']}"
+    return text
+
+def resize_and_process_image(input_path, output_path, spec=None, limits=None):
+    """
+    Process a single image, reporting success or failure on stdout.
     
     Args:
         input_path: Path to the input image
         output_path: Path to save the processed image
+        spec: Processing settings overriding image_processing.DEFAULT_SPEC
+        limits: Pre-flight limits overriding image_processing.DEFAULT_LIMITS
+
+    Returns:
+        True if the image was processed, False otherwise
     """
+    from image_processing import probe
     try:
-        # Open the image
-        with Image.open(input_path) as img:
-            # Calculate new dimensions while maintaining aspect ratio
-            original_width, original_height = img.size
-            new_width = 1200
-            new_height = int((new_width / original_width) * original_height)
-            
-            # Resize the image
-            resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Add 1-pixel black border
-            bordered_img = add_border(resized_img)
-            
-            # Save as JPG
-            bordered_img.save(output_path, 'JPEG', quality=95)
-            print(f"Successfully processed: {input_path} -> {output_path}")
-            
+        probe(input_path, limits)
+        info = process_image_file(input_path, output_path, spec)
+        print(describe_success(input_path, output_path, spec, info))
+        return True
     except Exception as e:
         print(f"Error processing {input_path}: {str(e)}")
+        return False
 
-def process_directory(input_dir, output_dir):
+def process_directory(input_dir, output_dir, workers=1, spec=None, incremental=False, prune=False,
+                      limits=None, pipelined=False, io_threads=4, recursive=False, include=None,
+                      exclude=None, memory_mb=None, archive=None):
     """
     Process all images in a directory.
     
+    Files are handed to the workers as the directory is walked, so the first
+    image starts processing straight away however large the tree is. Each one
+    is pre-flighted from its header on the way (see image_processing.probe),
+    so files that are not images or exceed the limits are reported without
+    being decoded or taking a worker.
+    
+    With a memory budget, each image's peak memory is estimated from its
+    header and a worker only starts on it once everything in flight fits
+    within the budget; images too large for the budget on their own are
+    reported as failed.
+    
+    With an archive path, every output is also added to a ZIP there as soon
+    as it is written (JPEG and WebP stored, not compressed again); the ZIP
+    only replaces an existing file once the batch is finished.
+    
     Args:
         input_dir: Directory containing input images
         output_dir: Directory to save processed images
+        workers: Number of worker processes (0 means one per CPU core)
+        spec: Processing settings overriding image_processing.DEFAULT_SPEC
+        incremental: Skip images whose content and parameters match the
+                     manifest kept in output_dir
+        prune: Delete outputs whose source image is gone (uses the manifest)
+        limits: Pre-flight limits overriding image_processing.DEFAULT_LIMITS
+        pipelined: Overlap reading, processing and writing in separate thread
+                   pools (see batch_processing.run_pipelined); `workers` is then
+                   the number of processing threads
+        io_threads: Reading and writing threads each, in pipelined mode
+        recursive: Include subdirectories, mirroring their structure in output_dir
+        include: Glob patterns selecting files by path relative to input_dir
+        exclude: Glob patterns of files and directories to leave out
+        memory_mb: Memory budget in MB shared by all workers (None means no limit)
+        archive: Path of a ZIP file to collect the outputs in
+
+    Returns:
+        dict summarising the batch (see batch_processing.summarize)
     """
+    import tempfile
+    import zipfile
+    from archive import add_file
+    from batch_processing import BatchResult, replace_into_place, run_batch, run_pipelined, summarize
+    from discovery import iter_image_files
+    from image_processing import PreflightError, estimate_memory, output_extension, output_paths, probe
+    from manifest import Manifest, spec_fingerprint
+    from memory_budget import MemoryBudget
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    # Get all image files
-    image_extensions = ('.png', '.jpg', '.jpeg', '.webp', '.tiff')
-    image_files = [f for f in os.listdir(input_dir) 
-                 if f.lower().endswith(image_extensions)]
-    
-    for image_file in image_files:
-        input_path = os.path.join(input_dir, image_file)
-        output_path = os.path.join(output_dir, os.path.splitext(image_file)[0] + '.jpg')
-        resize_and_process_image(input_path, output_path)
+    manifest = Manifest(output_dir) if incremental or prune else None
+    params = spec_fingerprint(spec)
+    extension = output_extension(spec)
+    keys = {}  # input path -> manifest key (path relative to input_dir)
+    digests = {}
+    rejected = []
+    counts = {'skipped': 0}
+    budget = None
+    if memory_mb:
+        fd, ledger = tempfile.mkstemp(prefix='memory-budget-', suffix='.json')
+        os.close(fd)
+        # A batch queues rather than rejects: wait as long as it takes for room
+        budget = MemoryBudget(int(memory_mb * 1024 * 1024), path=ledger, timeout=None)
 
-def main():
-    parser = argparse.ArgumentParser(description='Resize images to 1200px width, maintain aspect ratio, add border, and convert to JPG')
-    parser.add_argument('input', help='Input file or directory')
-    parser.add_argument('output', help='Output file or directory')
+    def discover():
+        """Yield a task per image as the walk finds it."""
+        made_dirs = {''}
+        for relative in iter_image_files(input_dir, recursive, include, exclude, skip=output_dir):
+            input_path = os.path.join(input_dir, *relative.split('/'))
+            keys[input_path] = relative
+            output_path = os.path.join(output_dir, *(os.path.splitext(relative)[0] + extension).split('/'))
+            if incremental:
+                current, digests[relative] = manifest.is_current(relative, input_path, params)
+                if current:
+                    counts['skipped'] += 1
+                    continue
+            try:
+                info = probe(input_path, limits)
+                reservation = None
+                if budget is not None:
+                    needed = estimate_memory(info, spec)
+                    if needed > budget.limit:
+                        raise PreflightError(f'Processing needs about {needed / 2**20:.0f}MB, '
+                                             f'more than the {memory_mb:g}MB memory budget')
+                    reservation = budget.reserve(needed)
+            except PreflightError as e:
+                print(f"Rejected {input_path}: {e}")
+                rejected.append(BatchResult((input_path, output_path, spec), str(e), 0.0))
+                continue
+            subdir = os.path.dirname(relative)
+            if subdir not in made_dirs:
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                made_dirs.add(subdir)
+            yield input_path, output_path, spec, reservation
+    tasks = discover()
+
+    bundle = None
+    if archive:
+        fd, archive_tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(archive)), suffix='.tmp')
+        os.close(fd)
+        bundle = zipfile.ZipFile(archive_tmp, 'w')
+
+    started = time.perf_counter()
+    results = []
+    try:
+        if pipelined:
+            batch = run_pipelined(read_image_file, process_image_data, write_image_outputs, tasks,
+                                  readers=io_threads, workers=workers, writers=io_threads)
+        else:
+            batch = run_batch(process_image_file, tasks, workers=workers)
+        for result in batch:
+            input_path, output_path = result.task[:2]
+            if result.error is None:
+                print(describe_success(input_path, output_path, spec, result.value))
+                if manifest is not None:
+                    key = keys[input_path]
+                    manifest.record(key, input_path, params,
+                                    output_paths(output_path, spec), digests.get(key))
+                if bundle is not None:
+                    for path in output_paths(output_path, spec):
+                        add_file(bundle, path, os.path.relpath(path, output_dir).replace(os.sep, '/'))
+            else:
+                print(f"Error processing {input_path}: {result.error}")
+            results.append(result)
+        if counts['skipped']:
+            print(f"Skipped {counts['skipped']} unchanged images")
+        if prune:
+            for path in manifest.prune(input_dir):
+                print(f"Removed output of deleted source: {path}")
+        if bundle is not None:
+            bundle.close()
+            replace_into_place(archive_tmp, archive)
+            bundle = None
+            print(f"Archived outputs in {archive}")
+    finally:
+        if manifest is not None:
+            manifest.save()
+        if budget is not None:
+            os.remove(ledger)
+        if bundle is not None:
+            bundle.close()
+            os.remove(archive_tmp)
+
+    results.extend(rejected)
+    summary = summarize(results, started)
+    summary['skipped'] = counts['skipped']
+    encoded = [r.value for r in results if r.error is None]
+    summary['output_bytes'] = sum(info['output_bytes'] for info in encoded)
+    summary['encode_seconds'] = sum(info['timings'].get('encode', 0.0) for info in encoded)
+    summary['stage_seconds'] = {}
+    for info in encoded:
+        for name, seconds in info['timings'].items():
+            summary['stage_seconds'][name] = summary['stage_seconds'].get(name, 0.0) + seconds
+    print(f"Processed {summary['succeeded']} of {summary['total']} images "
+          f"({summary['failed']} failed) in {summary['elapsed']:.2f}s "
+          f"({summary['images_per_sec']:.1f} images/sec)")
+    if encoded:
+        print(f"Wrote {summary['output_bytes'] / 1024 / 1024:.1f}MB; encoding took "
+              f"{summary['encode_seconds'] * 1000 / len(encoded):.1f}ms per image")
+    return summary
+
+def warm_worker():
+    """Pool initializer: load Pillow's plugins and codecs before the first real image."""
+    from PIL import Image
+    from image_processing import build_pipeline
+    Image.init()
+    sample = io.BytesIO()
+    Image.new('RGB', (64, 48)).save(sample, 'JPEG')
+    build_pipeline({'width': 32}).process_bytes(sample.getvalue())
+
+def watch_directory(input_dir, output_dir, workers=1, spec=None, limits=None, recursive=False,
+                    include=None, exclude=None, settle=None, poll_interval=None, stop=None):
+    """
+    Process images as they are dropped into a directory, until interrupted.
     
-    args = parser.parse_args()
+    The directory is watched with inotify where available (see folder_watch),
+    so a new file is noticed without re-scanning, and is handed over once it
+    has stopped changing for `settle` seconds. The worker processes are
+    started and warmed up front and stay running, so each image is picked up
+    straight away. Images already present, and any dropped while the watch
+    was not running, are processed first; the manifest in output_dir keeps
+    unchanged ones from being done twice.
     
+    Args:
+        input_dir: Directory to watch
+        output_dir: Directory to save processed images (may be inside input_dir)
+        workers: Number of worker processes (0 means one per CPU core)
+        spec: Processing settings overriding image_processing.DEFAULT_SPEC
+        limits: Pre-flight limits overriding image_processing.DEFAULT_LIMITS
+        recursive: Include subdirectories, mirroring their structure in output_dir
+        include: Glob patterns selecting files by path relative to input_dir
+        exclude: Glob patterns of files and directories to leave out
+        settle: Seconds a file must be unchanged before it is processed
+                (default folder_watch.SETTLE_SECONDS)
+        poll_interval: Poll every this many seconds instead of using inotify
+        stop: Callable; watching ends once it returns true
+
+    Returns:
+        Number of images processed
+    """
+    from batch_processing import start_pool, submit_task
+    from folder_watch import SETTLE_SECONDS, watch
+    from image_processing import PreflightError, output_extension, output_paths, probe
+    from manifest import Manifest, spec_fingerprint
+
+    if settle is None:
+        settle = SETTLE_SECONDS
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Manifest(output_dir)
+    params = spec_fingerprint(spec)
+    extension = output_extension(spec)
+    executor = start_pool(workers, warm_worker)
+    pending = {}  # future -> (manifest key, content hash)
+    processed = 0
+
+    def collect(block=False):
+        nonlocal processed
+        done = [future for future in pending if block or future.done()]
+        for future in done:
+            key, digest = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:  # the pool itself failed, e.g. a worker was killed
+                print(f"Error processing {key}: {e}")
+                continue
+            input_path, output_path = result.task[:2]
+            if result.error is None:
+                print(describe_success(input_path, output_path, spec, result.value))
+                manifest.record(key, input_path, params, output_paths(output_path, spec), digest)
+                processed += 1
+            else:
+                print(f"Error processing {input_path}: {result.error}")
+        if done:
+            manifest.save()
+
+    print(f"Watching {input_dir} (Ctrl+C to stop)")
+    try:
+        for relative in watch(input_dir, recursive, include, exclude, skip=output_dir, settle=settle,
+                              poll_interval=poll_interval, stop=stop):
+            if relative is not None:
+                input_path = os.path.join(input_dir, *relative.split('/'))
+                output_path = os.path.join(output_dir, *(os.path.splitext(relative)[0] + extension).split('/'))
+                try:
+                    current, digest = manifest.is_current(relative, input_path, params)
+                    if current:
+                        continue
+                    probe(input_path, limits)
+                except (OSError, PreflightError) as e:
+                    print(f"Rejected {input_path}: {e}")
+                    continue
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                pending[submit_task(executor, process_image_file, (input_path, output_path, spec))] = \
+                    (relative, digest)
+            collect()
+    except KeyboardInterrupt:
+        print("Stopping; finishing images already started")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        pending = {future: value for future, value in pending.items() if not future.cancelled()}
+        collect(block=True)
+    return processed
+
+def parse_sizes(value):
+    """Parse a comma-separated list of widths such as "1200,800,400"."""
+    import argparse
+    try:
+        sizes = [int(width) for width in value.split(',') if width.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid sizes: {value!r}")
+    if not sizes or min(sizes) <= 0:
+        raise argparse.ArgumentTypeError(f"invalid sizes: {value!r}")
+    return sizes
+
+def build_parser():
+    """Command-line options of the tool."""
+    import argparse
+    parser = argparse.ArgumentParser(description='Resize images to 1200px width, maintain aspect ratio, add border, and convert to JPG')
+    parser.add_argument('input', nargs='?', help='Input file or directory')
+    parser.add_argument('output', nargs='?', help='Output file or directory (optional with --archive)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes for directory input (0 = one per CPU core)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Overlap reading, processing and writing (helps most on network shares); '
+                             '--workers sets the processing threads')
+    parser.add_argument('--io-threads', type=int, default=4,
+                        help='Reading and writing threads each with --pipeline (default: 4)')
+    parser.add_argument('--exact', action='store_true',
+                        help='Resample from the full-resolution image instead of shrinking on load')
+    parser.add_argument('--sizes', type=parse_sizes,
+                        help='Comma-separated widths to make from one decode, e.g. 1200,800,400,150 '
+                             '(written as name_1200.jpg, name_800.jpg, ...)')
+    parser.add_argument('--recursive', action='store_true',
+                        help='Include subdirectories, mirroring their structure in the output')
+    parser.add_argument('--include', action='append',
+                        help='Only process files whose relative path matches this glob (repeatable)')
+    parser.add_argument('--exclude', action='append',
+                        help='Skip files and directories whose relative path matches this glob (repeatable)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and process images as they are added to the input directory')
+    parser.add_argument('--settle', type=float,
+                        help='With --watch, seconds a file must stop changing before it is processed '
+                             '(default: 0.5)')
+    parser.add_argument('--poll', type=float, metavar='SECONDS',
+                        help='With --watch, check the directory this often instead of using inotify')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process images that are new or changed since the last run')
+    parser.add_argument('--prune', action='store_true',
+                        help='Delete outputs whose source image no longer exists')
+    parser.add_argument('--format', choices=['jpeg', 'webp'],
+                        help='Output format (default: jpeg)')
+    parser.add_argument('--quality', type=int, help='Encoder quality, 1-100 (default: 95)')
+    parser.add_argument('--encoder', choices=['standard', 'fast', 'small'],
+                        help='fast: no optimisation passes; small: progressive + optimize (default: standard)')
+    parser.add_argument('--subsampling', choices=['4:4:4', '4:2:2', '4:2:0'],
+                        help='JPEG chroma subsampling')
+    parser.add_argument('--target-kb', type=int,
+                        help='Largest acceptable output size; searches for the highest quality that fits')
+    parser.add_argument('--max-megapixels', type=float,
+                        help='Reject larger images before decoding them (default: 80)')
+    parser.add_argument('--archive', metavar='ZIP',
+                        help='Also collect the outputs of a directory run in this ZIP file; '
+                             'without an output directory only the ZIP is kept')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help='Only process as many images at once as fit in this much memory '
+                             '(estimated from their headers)')
+    parser.add_argument('--serve', action='store_true',
+                        help='Stay running and process the command lines of later invocations, '
+                             'which then skip Python and Pillow start-up')
+    parser.add_argument('--no-server', action='store_true',
+                        help='Run in this process even if a --serve process is running')
+    return parser
+
+def run(args, parser):
+    """Carry out a parsed command line."""
     input_path = args.input
     output_path = args.output
+    if input_path is None:
+        parser.error('the input argument is required')
+    spec = {'exact': args.exact, 'sizes': args.sizes}
+    # Only set what was asked for, so existing manifests still match
+    encoding = {'format': args.format and args.format.upper(), 'quality': args.quality,
+                'encoder': args.encoder, 'subsampling': args.subsampling,
+                'target_bytes': args.target_kb and args.target_kb * 1024}
+    spec.update({name: value for name, value in encoding.items() if value is not None})
+    limits = {'max_pixels': int(args.max_megapixels * 1_000_000)} if args.max_megapixels else None
+    if args.archive and (args.watch or not os.path.isdir(input_path)):
+        parser.error('--archive needs an input directory and cannot be used with --watch')
+    if output_path is None and not args.archive:
+        parser.error('the output argument is required')
+    if output_path is None and (args.incremental or args.prune):
+        parser.error('--incremental and --prune need an output directory')
     
-    if os.path.isdir(input_path):
-        process_directory(input_path, output_path)
+    if args.watch:
+        if not os.path.isdir(input_path):
+            parser.error('--watch needs an input directory')
+        watch_directory(input_path, output_path, workers=args.workers, spec=spec, limits=limits,
+                        recursive=args.recursive, include=args.include, exclude=args.exclude,
+                        settle=args.settle, poll_interval=args.poll)
+    elif os.path.isdir(input_path):
+        import tempfile
+        with contextlib.ExitStack() as stack:
+            if output_path is None:
+                # Only the archive is wanted: stage the outputs in a directory removed afterwards
+                output_path = stack.enter_context(tempfile.TemporaryDirectory(prefix='resized-'))
+            process_directory(input_path, output_path, workers=args.workers, spec=spec,
+                              incremental=args.incremental, prune=args.prune, limits=limits,
+                              pipelined=args.pipeline, io_threads=args.io_threads,
+                              recursive=args.recursive, include=args.include, exclude=args.exclude,
+                              memory_mb=args.memory_budget, archive=args.archive)
     else:
-        resize_and_process_image(input_path, output_path)
+        resize_and_process_image(input_path, output_path, spec=spec, limits=limits)
+
+def run_forwarded(argv, cwd):
+    """Run a command line sent to the server by another invocation (see resize_server.serve)."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.serve or args.watch:
+        parser.error('--serve and --watch are not run by the server')
+    for name in ('input', 'output', 'archive'):
+        if getattr(args, name):
+            setattr(args, name, os.path.join(cwd, getattr(args, name)))
+    run(args, parser)
+
+def serve():
+    """
+    Run as the resize server until Ctrl+C.
+
+    Pillow, its codecs and the batch machinery are loaded and exercised
+    once up front, so forwarded invocations start working straight away.
+    """
+    import resize_server
+    # Load the rest of the tool now rather than during the first request
+    import archive, batch_processing, discovery, manifest, memory_budget
+    warm_worker()
+    resize_server.serve(run_forwarded)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not {'--serve', '--no-server', '--watch', '-h', '--help'} & set(argv):
+        # Hand the work to a running server if there is one: no Pillow start-up here
+        from resize_server import forward
+        status = forward(argv)
+        if status is not None:
+            sys.exit(status)
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.serve:
+        try:
+            serve()
+        except RuntimeError as e:
+            parser.error(str(e))
+        return
+    run(args, parser)
 
 if __name__ == "__main__":
     main()
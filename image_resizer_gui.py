@@ -1,84 +1,44 @@
 import os
 import sys
-from PIL import Image
-import tkinter as tk
-from tkinter import filedialog
-import subprocess
 
-def add_border(image, border_width=1, border_color=(0, 0, 0)):
+# image_resizer_cli loads Pillow only when an image is processed, and tkinter
+# is only needed for the folder dialog, so a folder dropped on the script is
+# handed to a running resize server without loading either
+import image_resizer_cli
+
+def process_directory(input_dir, workers=0, spec=None):
     """
-    Add a border to the image.
+    Process all images in a directory.
     
     Args:
-        image: PIL Image object
-        border_width: Width of the border in pixels
-        border_color: RGB tuple for border color (default is black)
-    
+        input_dir: Directory containing input images
+        workers: Number of worker processes (0 means one per CPU core)
+        spec: Processing settings overriding image_processing.DEFAULT_SPEC
+
     Returns:
-        PIL Image object with border
+        dict summarising the batch (see batch_processing.summarize)
     """
-    width, height = image.size
-    new_width = width + border_width * 2
-    new_height = height + border_width * 2
-    
-    bordered_image = Image.new('RGB', (new_width, new_height), border_color)
-    bordered_image.paste(image, (border_width, border_width))
-    return bordered_image
+    # Write into a "processed" folder next to the images
+    return image_resizer_cli.process_directory(
+        input_dir, os.path.join(input_dir, "processed"), workers=workers, spec=spec)
 
-def resize_and_process_image(input_path, output_path):
-    """
-    Resize image to 1200 pixels wide while maintaining aspect ratio,
-    add a 1-pixel black border, and save as JPG.
-    
-    Args:
-        input_path: Path to the input image
-        output_path: Path to save the processed image
+def watch_directory(input_dir, workers=0, spec=None):
     """
-    try:
-        # Open the image
-        with Image.open(input_path) as img:
-            # Calculate new dimensions while maintaining aspect ratio
-            original_width, original_height = img.size
-            new_width = 1200
-            new_height = int((new_width / original_width) * original_height)
-            
-            # Resize the image
-            resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Add 1-pixel black border
-            bordered_img = add_border(resized_img)
-            
-            # Save as JPG
-            bordered_img.save(output_path, 'JPEG', quality=95)
-            print(f"Successfully processed: {input_path} -> {output_path}")
-            
-    except Exception as e:
-        print(f"Error processing {input_path}: {str(e)}")
+    Keep processing images as they are added to a directory, until Ctrl+C.
 
-def process_directory(input_dir):
-    """
-    Process all images in a directory.
-    
     Args:
-        input_dir: Directory containing input images
+        input_dir: Directory to watch
+        workers: Number of worker processes (0 means one per CPU core)
+        spec: Processing settings overriding image_processing.DEFAULT_SPEC
     """
-    # Create output directory
-    output_dir = os.path.join(input_dir, "processed")
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    # Get all image files
-    image_extensions = ('.png', '.jpg', '.jpeg', '.webp', '.tiff')
-    image_files = [f for f in os.listdir(input_dir) 
-                 if f.lower().endswith(image_extensions)]
-    
-    for image_file in image_files:
-        input_path = os.path.join(input_dir, image_file)
-        output_path = os.path.join(output_dir, os.path.splitext(image_file)[0] + '.jpg')
-        resize_and_process_image(input_path, output_path)
+    image_resizer_cli.watch_directory(
+        input_dir, os.path.join(input_dir, "processed"), workers=workers, spec=spec)
 
 def select_folder():
     """Open a folder selection dialog and process the selected folder"""
+    import tkinter as tk
+    from tkinter import filedialog
+
     root = tk.Tk()
     root.withdraw()  # Hide the root window
     
@@ -91,11 +51,16 @@ def select_folder():
         print("No folder selected")
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[1] == "--watch":
+        # resize_watch.bat: keep processing a drop folder
+        watch_directory(sys.argv[2])
+    elif len(sys.argv) > 1:
         # If a folder was dragged onto the script
         folder_path = sys.argv[1]
         print(f"Processing folder: {folder_path}")
-        process_directory(folder_path)
+        from resize_server import forward
+        if forward([folder_path, os.path.join(folder_path, "processed"), "--workers", "0"]) is None:
+            process_directory(folder_path)
         print("Processing complete!")
     else:
         # If no folder was dragged, open the folder selection dialog
@@ -0,0 +1,430 @@
+"""
+Job Queue
+SQLite-backed queue of image jobs drained by a pool of worker processes
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from memory_budget import process_alive
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, every caller starts its own pool
+    fcntl = None
+
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), 'jobs.sqlite3')
+
+# A task whose worker died this many times (e.g. killed for running out of
+# memory) is reported as failed rather than handed to yet another worker
+MAX_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    params TEXT NOT NULL,
+    receiving INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    input_path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    result TEXT,
+    worker_pid INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, id);
+CREATE INDEX IF NOT EXISTS tasks_job ON tasks(job_id, position);
+'''
+
+
+class QueueFull(Exception):
+    """Raised when enqueuing would exceed the queue's capacity."""
+
+
+class JobQueue:
+    """
+    Persistent job queue stored in a SQLite database.
+
+    A job is one upload request; each of its files is a task that any worker
+    can pick up, so the files of one job are processed in parallel.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, max_pending=500):
+        """
+        Args:
+            db_path: Path of the SQLite database file
+            max_pending: Maximum number of queued or running tasks
+        """
+        self.db_path = db_path
+        self.max_pending = max_pending
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            _add_column(conn, 'jobs', 'receiving', 'INTEGER NOT NULL DEFAULT 0')
+            _add_column(conn, 'tasks', 'worker_pid', 'INTEGER')
+            _add_column(conn, 'tasks', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def pending(self):
+        """Number of tasks that are queued or running."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN ('queued', 'running')").fetchone()
+        return row[0]
+
+    def create(self, **params):
+        """
+        Start a job whose files are added one by one with add().
+
+        Workers pick up each file as soon as it is added; the job is only
+        reported as done once close() has been called.
+
+        Args:
+            **params: Processing parameters passed to the handler for every file
+
+        Returns:
+            The new job ID
+        """
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            conn.execute('INSERT INTO jobs (id, created, params, receiving) VALUES (?, ?, ?, 1)',
+                         (job_id, time.time(), json.dumps(params)))
+        return job_id
+
+    def add(self, job_id, position, input_path, filename, result=None):
+        """
+        Add a file to a job created with create().
+
+        Args:
+            job_id: The job
+            position: Index of the file in the upload, for the order of results
+            input_path: Spooled copy of the file, which the worker deletes
+            filename: Name the file was uploaded under
+            result: For a file that needs no processing (e.g. rejected up
+                    front), its result; the task is stored as finished
+
+        Raises:
+            QueueFull: If the queue already holds max_pending tasks
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if result is None:
+                pending = conn.execute(
+                    "SELECT COUNT(*) FROM tasks WHERE status IN ('queued', 'running')").fetchone()[0]
+                if pending >= self.max_pending:
+                    conn.execute('ROLLBACK')
+                    raise QueueFull(f'Queue is full ({pending} tasks pending)')
+                row = (job_id, position, input_path, filename, 'queued', None)
+            else:
+                row = (job_id, position, '', filename, result.get('status', 'error'), json.dumps(result))
+            conn.execute(
+                'INSERT INTO tasks (job_id, position, input_path, filename, status, result) '
+                'VALUES (?, ?, ?, ?, ?, ?)', row)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def close(self, job_id):
+        """Mark a job as complete: no more files will be added."""
+        with closing(self._connect()) as conn:
+            conn.execute('UPDATE jobs SET receiving = 0 WHERE id = ?', (job_id,))
+
+    def cancel(self, job_id):
+        """
+        Delete a job, e.g. one whose upload failed part-way.
+
+        Tasks a worker is running finish on their own (and delete their input).
+
+        Returns:
+            Input paths of the tasks that were still queued, for the caller to delete
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            paths = [row[0] for row in conn.execute(
+                "SELECT input_path FROM tasks WHERE job_id = ? AND status = 'queued'", (job_id,))]
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return paths
+
+    def claim(self):
+        """
+        Take the oldest queued task and mark it running in this process.
+
+        Returns:
+            (task_id, input_path, filename, params) or None if the queue is empty
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT tasks.id, input_path, filename, params FROM tasks "
+                "JOIN jobs ON jobs.id = tasks.job_id "
+                "WHERE status = 'queued' ORDER BY tasks.id LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute("UPDATE tasks SET status = 'running', worker_pid = ?, attempts = attempts + 1 "
+                             "WHERE id = ?", (os.getpid(), row[0]))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        task_id, input_path, filename, params = row
+        return task_id, input_path, filename, json.loads(params)
+
+    def finish(self, task_id, result):
+        """Store a task's result dict; its status is taken from result['status']."""
+        with closing(self._connect()) as conn:
+            conn.execute('UPDATE tasks SET status = ?, result = ? WHERE id = ?',
+                         (result.get('status', 'success'), json.dumps(result), task_id))
+
+    def requeue_running(self, pids=None):
+        """
+        Put tasks left 'running' by dead workers back in the queue.
+
+        A task whose workers have died MAX_ATTEMPTS times is finished as an
+        error instead, and its input deleted.
+
+        Args:
+            pids: IDs of workers known to have died; by default every worker
+                  that is no longer alive
+
+        Returns:
+            Number of tasks requeued or failed
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute("SELECT id, input_path, filename, worker_pid, attempts FROM tasks "
+                                "WHERE status = 'running'").fetchall()
+            if pids is None:
+                dead = [row for row in rows if row[3] is None or not process_alive(row[3])]
+            else:
+                dead = [row for row in rows if row[3] in pids]
+            for task_id, input_path, filename, _, attempts in dead:
+                if attempts < MAX_ATTEMPTS:
+                    conn.execute("UPDATE tasks SET status = 'queued', worker_pid = NULL WHERE id = ?",
+                                 (task_id,))
+                    continue
+                result = {'filename': filename, 'status': 'error',
+                          'message': f'The worker processing this image stopped {attempts} times '
+                                     f'(e.g. out of memory)'}
+                conn.execute("UPDATE tasks SET status = 'error', result = ? WHERE id = ?",
+                             (json.dumps(result), task_id))
+                try:
+                    os.remove(input_path)
+                except OSError:
+                    pass
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return len(dead)
+
+    def status(self, job_id):
+        """
+        Report a job's progress.
+
+        Returns:
+            dict with counts and the results finished so far, or None if unknown
+        """
+        with closing(self._connect()) as conn:
+            job = conn.execute('SELECT receiving FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if job is None:
+                return None
+            rows = conn.execute(
+                'SELECT filename, status, result FROM tasks WHERE job_id = ? ORDER BY position',
+                (job_id,)).fetchall()
+
+        counts = {'queued': 0, 'running': 0, 'success': 0, 'error': 0}
+        results = []
+        for filename, status, result in rows:
+            counts[status] = counts.get(status, 0) + 1
+            results.append(json.loads(result) if result else {'filename': filename, 'status': status})
+
+        finished = counts['success'] + counts['error']
+        if finished == len(rows) and not job[0]:
+            state = 'done'
+        elif counts['running'] or finished:
+            state = 'running'
+        else:
+            state = 'queued'
+        return {
+            'id': job_id,
+            'status': state,
+            'total': len(rows),
+            'completed': counts['success'],
+            'failed': counts['error'],
+            'results': results,
+        }
+
+    def purge(self, max_age):
+        """
+        Delete finished jobs created more than max_age seconds ago.
+
+        Jobs still being uploaded, or with files queued or running, are kept
+        however old they are.
+
+        Returns:
+            Input paths of the deleted tasks, for the caller to delete if
+            they are still on disk
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            expired = [row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE created < ? AND receiving = 0 AND NOT EXISTS "
+                "(SELECT 1 FROM tasks WHERE job_id = jobs.id AND status IN ('queued', 'running'))",
+                (time.time() - max_age,))]
+            paths = []
+            for job_id in expired:
+                paths.extend(row[0] for row in conn.execute(
+                    "SELECT input_path FROM tasks WHERE job_id = ? AND input_path != ''", (job_id,)))
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return paths
+
+def _add_column(conn, table, column, definition):
+    """Add a column that databases created by an older version lack."""
+    if column not in {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}:
+        try:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        except sqlite3.OperationalError:  # another process added it first
+            pass
+
+
+def worker_loop(db_path, handler, poll_interval=0.2):
+    """
+    Process tasks until the parent process exits.
+
+    Args:
+        db_path: Path of the queue database
+        handler: Module-level callable handler(input_path, filename, **params)
+                 returning the result dict for the task
+        poll_interval: Seconds to sleep when the queue is empty
+    """
+    queue = JobQueue(db_path)
+    parent = os.getppid()
+    while os.getppid() == parent:  # stop once the process that started us is gone
+        task = queue.claim()
+        if task is None:
+            time.sleep(poll_interval)
+            continue
+        task_id, input_path, filename, params = task
+        try:
+            result = handler(input_path, filename, **params)
+        except Exception as e:
+            result = {'filename': filename, 'status': 'error', 'message': str(e)}
+        queue.finish(task_id, result)
+
+
+def _start_worker(db_path, handler):
+    # Spawned, not forked: the caller is typically a threaded web worker, and
+    # a fork would copy whatever locks (or flock-held ledger files) its other
+    # threads hold at that moment, never to be released
+    process = multiprocessing.get_context('spawn').Process(
+        target=worker_loop, args=(db_path, handler), daemon=True)
+    process.start()
+    return process
+
+
+def supervise(db_path, handler, processes, interval=1.0):
+    """
+    Replace pool workers that have died, putting their tasks back in the queue.
+
+    Runs until the process exits; start_workers runs it in a daemon thread.
+
+    Args:
+        db_path: Path of the queue database
+        handler: The workers' handler
+        processes: The pool; dead processes are replaced in the list
+        interval: Seconds between checks
+    """
+    queue = JobQueue(db_path)
+    while True:
+        time.sleep(interval)
+        for i, process in enumerate(processes):
+            if process.is_alive():
+                continue
+            requeued = queue.requeue_running([process.pid])
+            logger.warning('job worker pid=%s exited code=%s requeued=%d; starting another',
+                           process.pid, process.exitcode, requeued)
+            processes[i] = _start_worker(db_path, handler)
+
+
+def start_workers(db_path, handler, count):
+    """
+    Start a supervised pool of daemon worker processes, once per machine.
+
+    The first caller takes an exclusive lock next to the database and keeps it
+    for as long as it lives; other callers (e.g. the remaining gunicorn
+    workers) see the lock and leave the pool alone. Tasks left running by
+    workers that are gone are requeued first, and a worker that dies later
+    (say, killed for running out of memory) is replaced.
+
+    The workers are spawned rather than forked, so the handler must be
+    importable, i.e. a module-level function.
+
+    Returns:
+        The pool's processes (kept up to date as workers are replaced), or an
+        empty list if another process owns the pool
+    """
+    if fcntl is not None:
+        lock_file = open(db_path + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return []
+        # Keep the lock for the lifetime of this process
+        start_workers._lock_file = lock_file
+
+    JobQueue(db_path).requeue_running()
+    processes = [_start_worker(db_path, handler) for _ in range(count)]
+    start_workers._supervisor = threading.Thread(target=supervise, args=(db_path, handler, processes),
+                                                 name='job-supervisor', daemon=True)
+    start_workers._supervisor.start()
+    return processes
+
+
+def main():
+    import argparse
+    from app import JOB_DB_PATH, process_job_file
+
+    parser = argparse.ArgumentParser(description='Run image job workers outside the web server')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes')
+    args = parser.parse_args()
+
+    processes = start_workers(JOB_DB_PATH, process_job_file, args.workers)
+    if not processes:
+        print(f"Workers for {JOB_DB_PATH} are already running")
+        return
+    print(f"Started {len(processes)} workers on {JOB_DB_PATH}")
+    start_workers._supervisor.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Processing Manifest
+Remember what was made from each input so unchanged files can be skipped next run
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+MANIFEST_NAME = '.resize_manifest.json'
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """Hex SHA-256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def spec_fingerprint(spec):
+    """Stable string identifying a set of processing parameters."""
+    return hashlib.sha256(json.dumps(spec or {}, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Manifest:
+    """
+    Record of processed inputs, stored as JSON in the output directory.
+
+    Each entry is keyed by the input's path relative to the input directory and
+    holds its size, mtime, content hash, the processing parameters and the
+    outputs written for it.
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_current(self, key, input_path, params):
+        """
+        Whether the outputs recorded for this input are up to date.
+
+        Size and mtime are checked first; the content is only hashed when they
+        differ, so a touched but unchanged file is still skipped.
+
+        Returns:
+            (is_current, content hash or None if it was not computed)
+        """
+        entry = self.entries.get(key)
+        stat = os.stat(input_path)
+        if entry is None or entry['params'] != params:
+            return False, None
+        if not all(os.path.exists(path) for path in entry['outputs']):
+            return False, None
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return True, entry['hash']
+
+        digest = file_hash(input_path)
+        if digest != entry['hash']:
+            return False, digest
+        entry['size'], entry['mtime'] = stat.st_size, stat.st_mtime
+        return True, digest
+
+    def record(self, key, input_path, params, outputs, digest=None):
+        """Store the entry for an input that was just processed."""
+        stat = os.stat(input_path)
+        self.entries[key] = {
+            'path': input_path,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': digest or file_hash(input_path),
+            'params': params,
+            'outputs': list(outputs),
+        }
+
+    def prune(self, input_dir):
+        """
+        Delete the outputs of inputs that no longer exist.
+
+        Only the recorded source is checked, not whether this run's walk saw
+        it, so a run that is not recursive or filters files leaves the
+        outputs of everything it did not look at alone.
+
+        Args:
+            input_dir: Directory the manifest keys are relative to
+
+        Returns:
+            List of removed output paths
+        """
+        removed = []
+        for key in [k for k in self.entries if not os.path.exists(os.path.join(input_dir, *k.split('/')))]:
+            for path in self.entries.pop(key)['outputs']:
+                try:
+                    os.remove(path)
+                    removed.append(path)
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def save(self):
+        """Write the manifest atomically."""
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,161 @@
+"""
+Memory Budget
+Admit image work only while the estimated memory of everything in flight fits a budget
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: the ledger cannot be locked, so the budget is per process
+    fcntl = None
+
+POLL_INTERVAL = 0.05  # seconds between attempts while waiting for room
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """Raised when work cannot be admitted under the memory budget."""
+
+
+def process_alive(pid):
+    """Whether a process with this ID exists (on this machine)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MemoryBudget:
+    """
+    Bytes of memory that image work may claim at once, shared between processes.
+
+    Every admitted job holds a reservation of its estimated peak footprint
+    (see image_processing.estimate_memory) until it finishes. Reservations
+    are kept in a small JSON ledger next to `path`, locked with flock, so
+    web workers, job workers and a batch's process pool all draw on the same
+    budget; those of processes that have died are dropped. Without a path
+    (or without fcntl) the ledger is private to this process.
+    """
+
+    def __init__(self, limit, path=None, timeout=30.0):
+        """
+        Args:
+            limit: Budget in bytes
+            path: Ledger file shared by every process using this budget
+            timeout: Seconds reserve() waits for room by default; None waits indefinitely
+        """
+        self.limit = limit
+        self.path = path if fcntl is not None else None
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._ledger = {}
+
+    def __getstate__(self):
+        # Sent to pool workers with their tasks; locks do not pickle
+        return {'limit': self.limit, 'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _update(self, change):
+        """Apply change(ledger) to the ledger under its lock and return the result."""
+        with self._lock:
+            if self.path is None:
+                return change(self._ledger)
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                text = f.read()
+                ledger = json.loads(text) if text else {}
+                ledger = {pid: held for pid, held in ledger.items() if process_alive(int(pid))}
+                result = change(ledger)
+                f.seek(0)
+                f.truncate()
+                json.dump(ledger, f)
+                return result
+
+    def in_use(self):
+        """Bytes currently reserved by every process sharing the budget."""
+        return self._update(lambda ledger: sum(sum(held.values()) for held in ledger.values()))
+
+    def reserve(self, nbytes, timeout=None):
+        """
+        Reservation of nbytes, taken when its `with` block is entered.
+
+        The reservation object is picklable, so it can be handed to a worker
+        process and entered there.
+
+        Args:
+            nbytes: Estimated peak memory of the work
+            timeout: Seconds to wait for room (default: the budget's timeout)
+
+        Returns:
+            Reservation
+        """
+        return Reservation(self, nbytes, self.timeout if timeout is None else timeout)
+
+    def _try_add(self, token, nbytes):
+        pid = str(os.getpid())
+
+        def add(ledger):
+            if sum(sum(held.values()) for held in ledger.values()) + nbytes > self.limit:
+                return False
+            ledger.setdefault(pid, {})[token] = nbytes
+            return True
+        return self._update(add)
+
+    def _remove(self, token):
+        pid = str(os.getpid())
+
+        def remove(ledger):
+            held = ledger.get(pid, {})
+            held.pop(token, None)
+            if not held:
+                ledger.pop(pid, None)
+        self._update(remove)
+
+
+class Reservation:
+    """A claim on part of a MemoryBudget for the duration of a `with` block."""
+
+    def __init__(self, budget, nbytes, timeout):
+        self.budget = budget
+        self.nbytes = nbytes
+        self.timeout = timeout
+        self.waited = 0.0
+        self._token = None
+
+    def __enter__(self):
+        """
+        Wait until the reservation fits, then take it.
+
+        Raises:
+            MemoryBudgetExceeded: If it can never fit, or did not fit within the timeout
+        """
+        budget = self.budget
+        if self.nbytes > budget.limit:
+            raise MemoryBudgetExceeded(f'Processing this image needs about {self.nbytes / 2**20:.0f}MB, '
+                                       f'more than the {budget.limit / 2**20:.0f}MB memory budget')
+        token = uuid.uuid4().hex
+        started = time.monotonic()
+        while not budget._try_add(token, self.nbytes):
+            self.waited = time.monotonic() - started
+            if self.timeout is not None and self.waited >= self.timeout:
+                raise MemoryBudgetExceeded(f'Server busy: no room for {self.nbytes / 2**20:.0f}MB of '
+                                           f'image processing within {self.timeout:.0f}s, try again shortly')
+            time.sleep(POLL_INTERVAL)
+        self.waited = time.monotonic() - started
+        self._token = token
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._token is not None:
+            self.budget._remove(self._token)
+            self._token = None
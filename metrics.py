@@ -0,0 +1,225 @@
+"""
+Metrics
+Counters and histograms rendered in the Prometheus text exposition format
+"""
+
+import json
+import os
+import tempfile
+import threading
+
+from memory_budget import process_alive
+
+try:
+    import fcntl
+except ImportError:  # Windows: files of exited processes are not folded and keep being read
+    fcntl = None
+
+# Upper bounds of histogram buckets; +Inf is implied
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1KB .. 1GB
+PIXELS_BUCKETS = (100_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 12_000_000,
+                  24_000_000, 50_000_000, 100_000_000)
+
+# Where the values of processes that have exited are added up, in the directory
+RETIRED_FILE = 'retired.json'
+
+
+def _label_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def _format_labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _merge(totals, snapshot, names=None):
+    """Add a snapshot's values into totals, for the metric names given (default: all)."""
+    for name, values in snapshot.items():
+        if names is not None and name not in names:
+            continue
+        target = totals.setdefault(name, {})
+        for key, value in values.items():
+            if isinstance(value, list):
+                current = target.setdefault(key, [0] * len(value))
+                target[key] = [a + b for a, b in zip(current, value)]
+            else:
+                target[key] = target.get(key, 0) + value
+
+
+class Metrics:
+    """
+    A registry of counters and histograms shared by the web and worker processes.
+
+    Every process keeps its own values in memory and, when given a directory,
+    writes them to <directory>/<pid>.json on flush(). render() adds up the
+    files of every process, so observations made in the job workers show up
+    in the web server's /metrics. The file of a process that has exited is
+    folded into a running total (RETIRED_FILE) and removed, so counters
+    stay monotonic without the directory growing with every restart.
+    """
+
+    def __init__(self, directory=None):
+        """
+        Args:
+            directory: Where each process stores its values (None keeps them in this process only)
+        """
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._definitions = {}  # name -> (type, help, buckets)
+        # name -> {label key: counter value, or histogram [per-bucket counts..., +Inf count, sum, count]}
+        self._values = {}
+        if hasattr(os, 'register_at_fork'):
+            # A forked worker starts from zero; its parent still reports what it inherited
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._values = {name: {} for name in self._definitions}
+
+    def counter(self, name, help_text):
+        """Declare a counter."""
+        self._definitions[name] = ('counter', help_text, None)
+        self._values.setdefault(name, {})
+
+    def histogram(self, name, help_text, buckets=SECONDS_BUCKETS):
+        """Declare a histogram with the given bucket upper bounds."""
+        self._definitions[name] = ('histogram', help_text, tuple(buckets))
+        self._values.setdefault(name, {})
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter."""
+        key = _label_key(labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record one observation in a histogram."""
+        buckets = self._definitions[name][2]
+        key = _label_key(labels)
+        with self._lock:
+            values = self._values[name]
+            if key not in values:
+                values[key] = [0] * (len(buckets) + 3)
+            state = values[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            else:
+                state[len(buckets)] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def flush(self):
+        """Write this process's values to the shared directory."""
+        if not self.directory:
+            return
+        with self._lock:
+            data = json.dumps(self._values)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.directory, f'{os.getpid()}.json'))
+
+    def _retire(self, paths):
+        """Fold the files of exited processes into RETIRED_FILE and remove them."""
+        with open(os.path.join(self.directory, RETIRED_FILE + '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.directory, RETIRED_FILE)
+            try:
+                with open(retired_path, 'r', encoding='utf-8') as f:
+                    retired = json.load(f)
+            except (OSError, ValueError):
+                retired = {}
+            folded = []
+            for path in paths:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        _merge(retired, json.load(f))
+                    folded.append(path)
+                except (OSError, ValueError):
+                    pass  # already folded by another process
+            if not folded:
+                return
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(retired, f)
+            os.replace(tmp_path, retired_path)
+            for path in folded:
+                os.remove(path)
+
+    def _collect(self):
+        """Values of every process, added together."""
+        with self._lock:
+            own = json.loads(json.dumps(self._values))
+        snapshots = [own]
+        if self.directory:
+            own_file = f'{os.getpid()}.json'
+            if fcntl is not None:
+                with os.scandir(self.directory) as it:
+                    exited = [entry.path for entry in it if entry.name.endswith('.json')
+                              and entry.name[:-5].isdigit() and not process_alive(int(entry.name[:-5]))]
+                if exited:
+                    self._retire(exited)
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith('.json') or entry.name == own_file:
+                        continue
+                    try:
+                        with open(entry.path, 'r', encoding='utf-8') as f:
+                            snapshots.append(json.load(f))
+                    except (OSError, ValueError):
+                        pass  # being replaced or removed; picked up next scrape
+
+        totals = {name: {} for name in self._definitions}
+        for snapshot in snapshots:
+            _merge(totals, snapshot, self._definitions)
+        return totals
+
+    def render(self, gauges=None):
+        """
+        Render every metric in the Prometheus text format.
+
+        Args:
+            gauges: Optional list of (name, help, value) read at scrape time
+
+        Returns:
+            The exposition text
+        """
+        lines = []
+        for name, values in self._collect().items():
+            kind, help_text, buckets = self._definitions[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key in sorted(values):
+                labels = [tuple(pair) for pair in json.loads(key)]
+                value = values[key]
+                if kind == 'counter':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value[:-2]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-2])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+        for name, help_text, value in gauges or ():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,77 @@
+"""
+Streaming Multipart
+Parse a multipart/form-data body incrementally, spooling each file to disk as it arrives
+"""
+
+import hashlib
+import os
+import uuid
+from collections import namedtuple
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+# One received file: `path` is its spooled copy (owned by the caller), `digest` a
+# hashlib.sha256 object already fed its bytes
+UploadPart = namedtuple('UploadPart', ['name', 'filename', 'path', 'size', 'digest'])
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_parts(stream, boundary, spool_dir, fields, chunk_size=CHUNK_SIZE, max_field_size=1024 * 1024):
+    """
+    Yield each file part of a multipart body as soon as its last byte has been read.
+
+    Only one chunk of the body is held in memory at a time: file data goes
+    straight to a new file in spool_dir and is hashed on the way. Form fields
+    are added to `fields` as they go by, so options sent before a file are
+    known when that file is yielded.
+
+    Args:
+        stream: Readable body, e.g. Flask's request.stream
+        boundary: The multipart boundary from the Content-Type header
+        spool_dir: Directory to write the files into
+        fields: dict that receives name -> value for every non-file field
+        chunk_size: Bytes read from the stream at a time
+        max_field_size: Upper bound on the size of one non-file field
+
+    Yields:
+        UploadPart for each file
+    """
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_field_size)
+    part = out = path = digest = None
+    size = 0
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    part, size, digest = event, 0, hashlib.sha256()
+                    path = os.path.join(spool_dir, uuid.uuid4().hex)
+                    out = open(path, 'wb')
+                elif isinstance(event, Field):
+                    part, value = event, []
+                elif isinstance(event, Data):
+                    if out is not None:
+                        out.write(event.data)
+                        digest.update(event.data)
+                        size += len(event.data)
+                    else:
+                        value.append(event.data)
+                    if not event.more_data:
+                        if out is None:
+                            fields[part.name] = b''.join(value).decode('utf-8', 'replace')
+                        else:
+                            out.close()
+                            upload = UploadPart(part.name, part.filename, path, size, digest)
+                            out = path = None
+                            yield upload
+                event = decoder.next_event()
+            if not chunk or isinstance(event, Epilogue):
+                break
+    finally:
+        # A body cut short (or a consumer that stopped early) leaves a partial file
+        if out is not None:
+            out.close()
+            os.remove(path)
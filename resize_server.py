@@ -0,0 +1,199 @@
+"""
+Resize Server
+Run command lines in one long-lived, warmed-up process that later invocations reach over a Unix socket
+"""
+
+import os
+import struct
+import sys
+
+# Where the server listens and clients look for it; one server per user
+SOCKET_PATH = os.environ.get('IMAGE_RESIZER_SOCKET') or os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp',
+    f"image-resizer-{getattr(os, 'getuid', lambda: 0)()}.sock")
+
+# The client sends the working directory and the arguments, "\0"-separated,
+# then shuts down its side. The server answers with frames of a tag byte and
+# a length followed by that many bytes: output for stdout or stderr as it is
+# printed, and finally the exit status.
+_FRAME = struct.Struct('!cI')
+_STDOUT, _STDERR, _EXIT = b'o', b'e', b'x'
+
+
+def forward(argv, path=SOCKET_PATH):
+    """
+    Run a command line in the server at path, relaying its output, if one is running.
+
+    Only the standard library's socket module is loaded, so this costs a few
+    milliseconds on top of interpreter start-up.
+
+    Args:
+        argv: Command-line arguments, without the program name
+        path: Socket the server listens on
+
+    Returns:
+        The command's exit status, or None if no server is listening
+    """
+    if not os.path.exists(path):
+        return None
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):  # Windows
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:  # left behind by a server that did not exit cleanly
+        client.close()
+        return None
+    with client:
+        client.sendall('\0'.join([os.getcwd()] + list(argv)).encode('utf-8', 'surrogateescape'))
+        client.shutdown(socket.SHUT_WR)
+        reader = client.makefile('rb')
+        while True:
+            header = reader.read(_FRAME.size)
+            if len(header) < _FRAME.size:
+                print('Error: the resize server closed the connection', file=sys.stderr)
+                return 1
+            tag, length = _FRAME.unpack(header)
+            payload = reader.read(length)
+            if tag == _EXIT:
+                return int(payload)
+            stream = sys.stdout if tag == _STDOUT else sys.stderr
+            stream.write(payload.decode('utf-8', 'replace'))
+            stream.flush()
+
+
+class _Frames:
+    """Text stream that sends what is written to a client as frames of one tag."""
+
+    def __init__(self, connection, tag, lock):
+        self.connection = connection
+        self.tag = tag
+        self.lock = lock
+        self.closed = False
+
+    def write(self, text):
+        data = text.encode('utf-8', 'replace')
+        if data and not self.closed:
+            try:
+                with self.lock:
+                    self.connection.sendall(_FRAME.pack(self.tag, len(data)) + data)
+            except OSError:
+                self.closed = True  # the client went away; let the command finish anyway
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _PerThread:
+    """Stands in for sys.stdout or sys.stderr, writing to the stream set for the current thread."""
+
+    def __init__(self, default):
+        import threading
+        self.default = default
+        self.local = threading.local()
+
+    def set(self, stream):
+        self.local.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, 'stream', None) or self.default, name)
+
+
+def serve(handler, path=SOCKET_PATH):
+    """
+    Answer forwarded command lines until interrupted.
+
+    Each connection is handled in its own thread, so several invocations can
+    run at once. What a command prints goes back to the client that sent it.
+    SIGTERM stops the server like Ctrl+C, removing the socket.
+
+    Args:
+        handler: handler(argv, cwd) runs one command line, with relative
+                 paths taken from cwd; SystemExit sets the exit status
+        path: Socket to listen on; only the current user can connect
+
+    Raises:
+        RuntimeError: If Unix sockets are not available, or another server
+                      is already listening at path
+    """
+    import signal
+    import socket
+    import socketserver
+    import threading
+    import time
+    import traceback
+
+    if not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError('The resize server needs Unix domain sockets, which this platform lacks')
+    if os.path.exists(path):
+        if is_running(path):
+            raise RuntimeError(f'A resize server is already listening on {path}')
+        os.remove(path)
+
+    stdout, stderr = _PerThread(sys.stdout), _PerThread(sys.stderr)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            started = time.perf_counter()
+            request = self.rfile.read()
+            if not request:  # someone checking whether we are running
+                return
+            cwd, *argv = request.decode('utf-8', 'surrogateescape').split('\0')
+            lock = threading.Lock()
+            stdout.set(_Frames(self.connection, _STDOUT, lock))
+            stderr.set(_Frames(self.connection, _STDERR, lock))
+            status = 0
+            try:
+                handler(argv, cwd)
+            except SystemExit as e:
+                if isinstance(e.code, int) or e.code is None:
+                    status = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                stdout.set(None)
+                stderr.set(None)
+            try:
+                self.connection.sendall(_FRAME.pack(_EXIT, len(str(status))) + str(status).encode())
+            except OSError:
+                pass
+            print(f"{' '.join(argv)} -> {status} ({(time.perf_counter() - started) * 1000:.0f}ms)")
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    previous_umask = os.umask(0o177)  # the socket is created 0600
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(previous_umask)
+    sys.stdout, sys.stderr = stdout, stderr
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Resize server listening on {path} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.stdout, sys.stderr = stdout.default, stderr.default
+        os.remove(path)
+
+
+def is_running(path=SOCKET_PATH):
+    """Whether a server is accepting connections at path."""
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except OSError:
+            return False
+    return True
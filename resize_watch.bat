@@ -0,0 +1,3 @@
+@echo off
+python "%~dp0image_resizer_gui.py" --watch %1
+pause
@@ -0,0 +1,154 @@
+"""
+Result Cache
+Content-addressed store for processed images, keyed on input bytes plus parameters
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def cache_key(data, **params):
+    """
+    Build a cache key from the raw input bytes and the processing parameters.
+
+    Args:
+        data: Raw bytes of the uploaded image, or a hashlib.sha256 object
+              already fed them (it is not modified)
+        **params: Processing parameters that affect the output (width, border, ...)
+
+    Returns:
+        Hex SHA-256 digest
+    """
+    digest = data.copy() if hasattr(data, 'hexdigest') else hashlib.sha256(data)
+    for name in sorted(params):
+        digest.update(f"\0{name}={params[name]!r}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Size-bounded on-disk cache with LRU eviction and an optional in-memory hot tier.
+
+    Entries are files named after their key. A hit touches the file's mtime, so
+    the least recently used entries are the ones with the oldest mtime.
+    """
+
+    def __init__(self, directory=None, max_bytes=512 * 1024 * 1024, memory_bytes=0):
+        """
+        Args:
+            directory: Where to keep cached results (default: a folder in the temp dir)
+            max_bytes: Upper bound on the total size of cached files
+            memory_bytes: Size of the in-memory hot tier (0 disables it)
+        """
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'result_cache')
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._disk_size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _entries(self):
+        """List (path, size, mtime) for every cached file."""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key):
+        """Return the cached bytes for key, or None on a miss."""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """Store data under key, evicting least recently used entries if needed."""
+        if len(data) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            previous = os.path.getsize(path)
+        except OSError:
+            previous = 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._disk_size += len(data) - previous
+            self._remember(key, data)
+            if self._disk_size > self.max_bytes:
+                self._evict()
+
+    def _remember(self, key, data):
+        """Add data to the hot tier. Caller holds the lock."""
+        if len(data) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+
+    def _evict(self):
+        """Delete the oldest files until the disk tier fits. Caller holds the lock."""
+        # Other processes may share the directory, so recount before evicting
+        entries = self._entries()
+        self._disk_size = sum(size for _, size, _ in entries)
+        for path, size, _ in sorted(entries, key=lambda e: e[2]):
+            if self._disk_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_size -= size
+            key = os.path.basename(path)
+            if key in self._memory:
+                self._memory_size -= len(self._memory.pop(key))
+
+    def stats(self):
+        """Return hit/miss counters and current tier sizes."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'disk_bytes': self._disk_size,
+                'memory_bytes': self._memory_size,
+            }
@@ -1,28 +1,20 @@
 from flask import Flask, request, jsonify, send_file
 from werkzeug.utils import secure_filename
 import os
-from PIL import Image
 import io
 
+from image_processing import PreflightError, build_pipeline, probe
+
 app = Flask(__name__, static_folder='static')
 
 # Helper function to process a single image
-def process_image(image):
-    print(f"Processing image with size: {image.size}")  # Debug log
-    # Resize to 1200px width while maintaining aspect ratio
-    original_width, original_height = image.size
-    new_width = 1200
-    new_height = int((new_width / original_width) * original_height)
-    
-    print(f"Resizing to: {new_width}x{new_height}")  # Debug log
-    # Resize the image
-    resized_img = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    # Add 1-pixel black border
-    bordered_img = Image.new('RGB', (new_width + 2, new_height + 2), (0, 0, 0))
-    bordered_img.paste(resized_img, (1, 1))
-    
-    return bordered_img
+def process_image(file, exact=False):
+    probe(file)  # reject non-images and oversized images from the header
+    info = {}
+    # Resize to 1200px width while maintaining aspect ratio, add 1-pixel black border and encode
+    data = build_pipeline(exact=exact).process_bytes(file, info)
+    print(f"Processed image with size: {info['source_size']}")  # Debug log
+    return data
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -42,13 +34,7 @@ def upload_file():
     try:
         print(f"Processing file: {file.filename}")  # Debug log
         # Process the image
-        img = Image.open(file)
-        processed_img = process_image(img)
-        
-        # Save to a BytesIO object
-        img_io = io.BytesIO()
-        processed_img.save(img_io, 'JPEG', quality=95)
-        img_io.seek(0)
+        img_io = io.BytesIO(process_image(file.stream, request.form.get('exact', 'false').lower() == 'true'))
         
         # Create a filename
         filename = f'processed_{secure_filename(file.filename)}'
@@ -61,6 +47,9 @@ def upload_file():
             download_name=filename
         )
         
+    except PreflightError as e:
+        print(f"Rejected: {str(e)}")  # Debug log
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Error: {str(e)}")  # Debug log
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,41 @@
+"""
+Manifest Tests
+Regression tests for incremental runs and --prune
+"""
+
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_resizer_cli import process_directory
+
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, 'sub'))
+    for relative in ('a.png', 'sub/c.png'):
+        Image.new('RGB', (64, 48), 'red').save(os.path.join(root, *relative.split('/')))
+
+
+def test_non_recursive_prune_keeps_outputs_of_unwalked_sources(tmp_path):
+    source, output = str(tmp_path / 'in'), str(tmp_path / 'out')
+    make_tree(source)
+    process_directory(source, output, incremental=True, recursive=True)
+    assert os.path.exists(os.path.join(output, 'sub', 'c.jpg'))
+
+    process_directory(source, output, incremental=True, prune=True)
+    assert os.path.exists(os.path.join(output, 'a.jpg'))
+    assert os.path.exists(os.path.join(output, 'sub', 'c.jpg'))
+
+
+def test_prune_removes_outputs_of_deleted_sources(tmp_path):
+    source, output = str(tmp_path / 'in'), str(tmp_path / 'out')
+    make_tree(source)
+    process_directory(source, output, incremental=True, recursive=True)
+    os.remove(os.path.join(source, 'sub', 'c.png'))
+
+    process_directory(source, output, incremental=True, prune=True, include=['a.*'])
+    assert os.path.exists(os.path.join(output, 'a.jpg'))
+    assert not os.path.exists(os.path.join(output, 'sub', 'c.jpg'))